@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 23 12:40:05 2024
+
+@author: ambric
+
+Headless version of EEGprepro.py for pre-processing the whole data set.
+
+Every subject goes through the same steps (import -> rename -> montage ->
+interpolate -> re-reference -> filter -> ICA -> save) in its own worker
+process. Nothing is plotted while the pool is running. A status/timing row is
+written for every subject, and subjects can be opened for review afterwards.
+"""
+import mne
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count
+
+from preproTools import defaultParams, discoverSubjects, preprocessSubject, reviewSubject
+
+##############################
+##STEP 0: INITIAL PARAMETERS##
+##############################
+
+params = dict(defaultParams)
+
+params["pathEEG"] = "../EEG_data_raw/"
+params["outPath"] = "../EEG_data_clean/"
+
+#lets the script know whether we have EOG electodes
+params["EOG"] = False
+
+#extra recordings if session split into multiple recordings
+params["additionalRecordings"] = {"S40" : ["S40b"]}
+
+#bad channels marked during recording
+params["badChannels"] = {}
+
+#resample after ICA, e.g. 250 Hz (None = keep the recorded rate)
+params["resample"] = None
+
+#memory-map the raw files and work chunk by chunk (for very long recordings)
+params["streaming"] = False
+
+#checkpoint every stage, so re-runs start from the first stage that changed
+params["cache"] = True
+params["cachePath"] = "../EEG_data_cache/"
+params["cacheMaxGB"] = 50
+
+#never block inside a worker
+params["review"] = False
+
+#subjects to run (None = every .vhdr in pathEEG)
+subjects = None
+
+#number of worker processes (None = all cores)
+nWorkers = None
+
+#where the status/timing record goes
+statusFile = params["outPath"] + "prepro_status.csv"
+
+#open each cleaned file once the batch is done
+reviewAfter = False
+
+#each worker quiet unless something goes wrong
+def runSubject(subject):
+    mne.set_log_level("WARNING")
+
+    return preprocessSubject(subject, params)
+
+if __name__ == "__main__":
+
+    ####################
+    ##STEP 1: SUBJECTS##
+    ####################
+
+    if subjects is None:
+        subjects = discoverSubjects(params["pathEEG"], params["additionalRecordings"])
+
+    print("Subjects found:", subjects)
+
+    if nWorkers is None:
+        nWorkers = min(cpu_count(), len(subjects))
+
+    ########################
+    ##STEP 2: PROCESS POOL##
+    ########################
+
+    records = []
+    with ProcessPoolExecutor(max_workers = max(nWorkers, 1)) as pool:
+        for record in pool.map(runSubject, subjects):
+            print(record["subject"], record["status"], "({:.1f} s)".format(record["seconds"]))
+            records.append(record)
+
+    #########################
+    ##STEP 3: STATUS RECORD##
+    #########################
+
+    status = pd.DataFrame(records)
+    status.to_csv(statusFile, index = False)
+
+    print("Status saved:", statusFile)
+    print("Failed:", list(status.subject[status.status.str.startswith("failed")]))
+
+    ###########################
+    ##STEP 4: OPTIONAL REVIEW##
+    ###########################
+
+    if reviewAfter:
+        for subject in status.subject[~status.status.str.startswith("failed")]:
+            reviewSubject(subject, params)
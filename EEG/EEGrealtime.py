@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr 13 15:40:51 2024
+
+@author: ambric
+
+Pre-processing + QC while a session is being recorded, so problems (a channel
+coming loose, lots of movement) get caught during the session instead of
+after a full reload.
+
+Tails the .eeg file the recorder is writing (or reads from a local socket
+standing in for the amplifier), interpolates/re-references, filters causally
+and applies an ICA block by block, and prints rolling QC for the last few
+seconds. The ICA is either one fitted earlier (e.g. EEGprepro.py on a previous
+session, saved as <subject>-ica.fif) or fitted on the first couple of minutes.
+
+To try it without an amplifier, play a recording into the socket from another
+console:
+
+    from realtimeTools import serveRecording
+    serveRecording("../EEG_data_raw/S27.vhdr", 50000)
+"""
+import mne
+import numpy as np
+
+from time import sleep, perf_counter
+
+from badChannels import detectBadChannels
+from brainvisionStream import designFilter, icaMatrix, spatialMatrix
+from icaTools import classifyComponents, fitDecimatedICA
+from realtimeTools import FileTail, OnlineProcessor, RingBuffer, SocketSource, artifactMetrics
+
+##############################
+##STEP 0: INITIAL PARAMETERS##
+##############################
+
+subject = "S27"
+
+pathEEG = "../EEG_data_raw/"
+
+#"file" = tail the .eeg being recorded, "socket" = amplifier stand-in
+source = "file"
+port = 50000
+
+#lets the script know whether we have EOG electodes
+EOG = False
+EOG_channels = ("LEYE_beside", "LEYE_below")
+
+montage = "easycap-M1"
+
+#channels already known to be bad (interpolated from the start)
+badChannels = []
+
+#causal filter (IIR), so it can run as data come in
+filterBand = (.1, 40)
+
+#pre-fitted ICA (None = fit one on the first icaCalibrationSeconds)
+icaFile = None
+icaCalibrationSeconds = 120
+
+#how much data to keep, how much to use for QC, how often to print it
+bufferSeconds = 60
+qcSeconds = 10
+updateSeconds = 2
+
+#stop when nothing new has come in for this long
+stopAfterIdle = 10
+
+mne.set_log_level("WARNING")
+
+#######################
+##STEP 1: DATA SOURCE##
+#######################
+
+vhdrPath = pathEEG + subject + ".vhdr"
+
+#someone typed the name of this channel wrong in the lab computer
+if source == "socket":
+    stream = SocketSource(vhdrPath, port, rename = {"FPz" : "Fpz"})
+else:
+    stream = FileTail(vhdrPath, rename = {"FPz" : "Fpz"})
+
+sfreq = stream.sfreq
+
+#drop EOG channels if not used for this recording
+keep = [ch for ch in stream.chNames if EOG or ch not in EOG_channels]
+picks = np.array([stream.chNames.index(ch) for ch in keep])
+
+info = mne.create_info(keep, sfreq, ["eog" if ch in EOG_channels else "eeg" for ch in keep])
+info.set_montage(montage)
+info["bads"] = [ch for ch in badChannels if ch in keep]
+
+eeg = mne.pick_types(info, eeg = True, exclude = [])
+eegInfo = mne.pick_info(info, eeg)
+
+###########################
+##STEP 2: ONLINE PIPELINE##
+###########################
+
+sos = designFilter(sfreq, *filterBand, method = "iir")
+processor = OnlineProcessor(picks, spatialMatrix(info), sos = sos)
+
+if icaFile is not None:
+    ica = mne.preprocessing.read_ica(icaFile)
+    processor.setICA(*icaMatrix(ica, info))
+    print("ICA loaded, excluding components:", ica.exclude)
+else:
+    ica = None
+
+#referenced data for bad channel QC, cleaned data for artifact QC
+nBuffer = int(max(bufferSeconds, icaCalibrationSeconds or 0, qcSeconds) * sfreq)
+referencedBuffer = RingBuffer(len(keep), nBuffer)
+cleanBuffer = RingBuffer(len(keep), nBuffer)
+
+####################
+##STEP 3: RUN LOOP##
+####################
+
+lastData = perf_counter()
+lastUpdate = perf_counter()
+processingSeconds = 0
+
+#QC window
+nQC = int(qcSeconds * sfreq)
+
+while True:
+    block = stream.read()
+
+    if block is None:
+        if perf_counter() - lastData > stopAfterIdle or getattr(stream, "closed", False):
+            break
+        sleep(.05)
+        continue
+
+    lastData = perf_counter()
+
+    start = perf_counter()
+    referenced, cleaned = processor.process(block)
+    referencedBuffer.write(referenced)
+    cleanBuffer.write(cleaned)
+    processingSeconds += perf_counter() - start
+
+    #fit the ICA once there's enough data (cleanBuffer is still pre-ICA here)
+    if ica is None and icaCalibrationSeconds and cleanBuffer.nWritten >= icaCalibrationSeconds * sfreq:
+        calibration = mne.io.RawArray(cleanBuffer.latest(int(icaCalibrationSeconds * sfreq)), info)
+        dataICA = calibration.filter(1, None)
+
+        ica, fitReport = fitDecimatedICA(dataICA, random_state = 97)
+        classifyComponents(ica, dataICA)
+        processor.setICA(*icaMatrix(ica, info))
+
+        print("ICA fitted on the first {} s ({:.1f} s), excluding components: {}".format(
+            icaCalibrationSeconds, fitReport["fitSeconds"], ica.exclude))
+
+    #rolling QC, once there's a full QC window
+    if perf_counter() - lastUpdate > updateSeconds and referencedBuffer.nWritten >= nQC:
+        lastUpdate = perf_counter()
+
+        bads, _ = detectBadChannels([referencedBuffer.latest(nQC)[eeg]], eegInfo)
+        metrics = artifactMetrics(cleanBuffer.latest(nQC), sfreq, keep)
+
+        recorded = cleanBuffer.nWritten / sfreq
+        print("t = {:.0f} s | bad: {} | {} | processing {:.1%} of real time".format(
+            recorded, ", ".join(bads) or "none",
+            " | ".join("{} {}".format(k, round(v, 1) if isinstance(v, float) else v) for k, v in metrics.items()),
+            processingSeconds / max(recorded, 1e-9)))
+
+print("Stream ended at {:.0f} s.".format(cleanBuffer.nWritten / sfreq))
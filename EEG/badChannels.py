@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 31 15:27:44 2024
+
+@author: ambric
+
+Automatic bad channel detection, to replace marking channels by hand in the
+first rawData.plot().
+
+The recording is cut into short windows (1 s by default) and every statistic
+is computed for all channels x windows at once:
+
+    flat      = raw standard deviation basically zero
+    deviation = amplitude (1-40 Hz) way off from the other channels
+                (robust z-score across channels, per window)
+    correlation = median |correlation| with the nearest neighbours on the
+                montage is low (channel isn't seeing the same brain)
+    noise     = ratio of >50 Hz to 1-40 Hz amplitude way off from the other
+                channels (robust z-score)
+
+A channel is bad for a criterion if it's flagged in more than badFraction of
+the windows. Data come in as chunks, so the same code works on a loaded
+recording and on a memory-mapped one (brainvisionStream.py).
+"""
+import mne
+import numpy as np
+import pandas as pd
+
+#default settings
+defaultCriteria = {"windowSeconds" : 1.,
+                   "flatThreshold" : 1e-7, #volts
+                   "deviationZ" : 5.,
+                   "correlationThreshold" : .4,
+                   "noiseZ" : 5.,
+                   "nNeighbours" : 4,
+                   "badFraction" : .4,
+                   }
+
+#k nearest channels on the montage (indices, channels x k)
+def montageNeighbours(info, k = 4):
+    positions = np.array([ch["loc"][:3] for ch in info["chs"]])
+
+    distances = np.linalg.norm(positions[:, np.newaxis] - positions[np.newaxis], axis = -1)
+    np.fill_diagonal(distances, np.inf)
+
+    return np.argsort(distances, axis = 1)[:, :k]
+
+#robust z-score across channels (axis 0), separately for each window
+def robustZ(values):
+    median = np.median(values, axis = 0, keepdims = True)
+    mad = 1.4826 * np.median(np.abs(values - median), axis = 0, keepdims = True)
+
+    return (values - median) / np.where(mad > 0, mad, np.inf)
+
+#channels x windows statistics for one chunk (channels x samples, volts)
+def chunkStatistics(data, sfreq, neighbours, windowSeconds = 1.):
+    win = int(windowSeconds * sfreq)
+    nWin = data.shape[1] // win
+    if nWin == 0:
+        return None
+
+    #drift/line noise out for amplitude + correlation. high band for noise
+    low = mne.filter.filter_data(data, sfreq, 1, 40, verbose = False)
+    if sfreq > 2 * 60:
+        high = mne.filter.filter_data(data, sfreq, 50, None, verbose = False)
+    else:
+        high = np.zeros_like(data)
+
+    #channels x windows x samples (views, no copies)
+    shape = (data.shape[0], nWin, win)
+    data = data[:, :nWin * win].reshape(shape)
+    low = low[:, :nWin * win].reshape(shape)
+    high = high[:, :nWin * win].reshape(shape)
+
+    amplitude = low.std(axis = 2)
+
+    #normalized windows, so the mean of a product = correlation
+    z = (low - low.mean(axis = 2, keepdims = True)) / np.where(amplitude > 0, amplitude, np.inf)[:, :, np.newaxis]
+    correlation = np.stack([(z * z[neighbours[:, j]]).mean(axis = 2)
+                            for j in range(neighbours.shape[1])], axis = 1)
+
+    stats = {"rawStd" : data.std(axis = 2),
+             "amplitude" : amplitude,
+             "correlation" : np.median(np.abs(correlation), axis = 1),
+             "noise" : high.std(axis = 2) / np.where(amplitude > 0, amplitude, np.inf),
+             }
+
+    return stats
+
+#bad channels from a stream of chunks. chunks = channels x samples in volts,
+#for the channels in info (in that order). returns (bads, report), with no
+#bads and an empty report if no chunk holds a full window
+def detectBadChannels(chunks, info, criteria = None):
+    criteria = dict(defaultCriteria, **(criteria or {}))
+
+    sfreq = info["sfreq"]
+    neighbours = montageNeighbours(info, criteria["nNeighbours"])
+
+    stats = [chunkStatistics(chunk, sfreq, neighbours, criteria["windowSeconds"]) for chunk in chunks]
+    stats = [s for s in stats if s is not None]
+
+    #not one full window yet
+    if not stats:
+        report = pd.DataFrame(index = pd.Index(info["ch_names"], name = "channel"),
+                              columns = ["flat", "deviation", "correlation", "noise", "median_amplitude_uV",
+                                         "median_neighbour_corr", "reason", "bad"])
+        report["reason"] = ""
+        report["bad"] = False
+
+        return [], report
+
+    stats = {key : np.concatenate([s[key] for s in stats], axis = 1) for key in stats[0]}
+
+    #channels x windows flags
+    flat = stats["rawStd"] < criteria["flatThreshold"]
+    deviation = np.abs(robustZ(np.log(stats["amplitude"] + 1e-20))) > criteria["deviationZ"]
+    correlation = stats["correlation"] < criteria["correlationThreshold"]
+    noise = robustZ(stats["noise"]) > criteria["noiseZ"]
+
+    report = pd.DataFrame(index = pd.Index(info["ch_names"], name = "channel"))
+    report["flat"] = flat.mean(axis = 1)
+    report["deviation"] = deviation.mean(axis = 1)
+    report["correlation"] = correlation.mean(axis = 1)
+    report["noise"] = noise.mean(axis = 1)
+
+    #typical values, for checking afterwards
+    report["median_amplitude_uV"] = np.median(stats["amplitude"], axis = 1) * 1e6
+    report["median_neighbour_corr"] = np.median(stats["correlation"], axis = 1)
+
+    over = report[["flat", "deviation", "correlation", "noise"]] > criteria["badFraction"]
+    report["reason"] = [", ".join(over.columns[row]) for row in over.values]
+    report["bad"] = over.any(axis = 1)
+
+    bads = list(report.index[report.bad])
+
+    return bads, report
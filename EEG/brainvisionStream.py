@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Mar 24 14:18:50 2024
+
+@author: ambric
+
+Out-of-core pre-processing for BrainVision recordings.
+
+The .eeg binary is memory-mapped instead of loaded, and the linear steps
+(bad channel interpolation + average reference as one spatial matrix, then
+FIR/IIR filtering) are applied chunk by chunk. Results are written straight
+back to disk as float32 BrainVision files that MNE can open with
+preload = False, so peak memory depends on the chunk size, not on how long
+the recording is.
+
+Split sessions are concatenated lazily: each recording is filtered on its own
+(same as MNE does across an append boundary) and written one after the other
+into the same output file, with a "New Segment" marker at the join.
+
+The last pass can also resample (polyphase, same filter as scipy/MNE), with
+the marker positions moved to the new rate.
+"""
+import mne
+import numpy as np
+
+from fractions import Fraction
+from os import path
+from scipy.signal import oaconvolve, resample_poly, sosfilt, sosfilt_zi
+
+#BrainVision binary formats -> numpy
+binaryFormats = {"INT_16" : "<i2", "INT_32" : "<i4", "IEEE_FLOAT_32" : "<f4"}
+
+#units in the header -> volts
+unitScales = {"V" : 1., "mV" : 1e-3, "µV" : 1e-6, "uV" : 1e-6, "nV" : 1e-9}
+
+#commas in BrainVision names are coded as \1
+def decodeField(field):
+    return field.replace("\\1", ",")
+
+def encodeField(field):
+    return field.replace(",", "\\1")
+
+#sections of a .vhdr/.vmrk file as {section : {key : value}}
+def readSections(filePath):
+    with open(filePath, "rb") as f:
+        raw = f.read()
+
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = raw.decode("latin-1")
+
+    sections = {}
+    section = None
+    for line in text.splitlines():
+        line = line.strip()
+
+        if line.startswith("[") and line.endswith("]"):
+            section = line[1:-1]
+            sections[section] = {}
+        elif section is not None and "=" in line and not line.startswith(";"):
+            key, value = line.split("=", 1)
+            sections[section][key] = value
+
+    return sections
+
+#everything we need from the header to read the binary
+def readHeader(vhdrPath):
+    sections = readSections(vhdrPath)
+    common = sections["Common Infos"]
+
+    nChannels = int(common["NumberOfChannels"])
+
+    chNames = []
+    scales = []
+    for i in range(1, nChannels + 1):
+        fields = sections["Channel Infos"]["Ch" + str(i)].split(",")
+        resolution = float(fields[2]) if len(fields) > 2 and fields[2] else 1.
+        unit = fields[3] if len(fields) > 3 and fields[3] else "µV"
+
+        chNames.append(decodeField(fields[0]))
+        scales.append(resolution * unitScales[unit])
+
+    folder = path.dirname(vhdrPath)
+    header = {"dataFile" : path.join(folder, common["DataFile"]),
+              "markerFile" : path.join(folder, common.get("MarkerFile", "")),
+              "nChannels" : nChannels,
+              "sfreq" : 1e6 / float(common["SamplingInterval"]),
+              "dtype" : binaryFormats[sections["Binary Infos"]["BinaryFormat"]],
+              "orientation" : common.get("DataOrientation", "MULTIPLEXED"),
+              "chNames" : chNames,
+              "scales" : np.array(scales),
+              }
+
+    return header
+
+#markers as [type, description, position (0-based), size]
+def readMarkers(vmrkPath):
+    markers = []
+    if not path.isfile(vmrkPath):
+        return markers
+
+    for key, value in readSections(vmrkPath).get("Marker Infos", {}).items():
+        if not key.startswith("Mk"):
+            continue
+
+        fields = value.split(",")
+        markers.append([decodeField(fields[0]), decodeField(fields[1]),
+                        int(fields[2]) - 1, int(fields[3]) if fields[3] else 1])
+
+    markers.sort(key = lambda m: m[2])
+
+    return markers
+
+#one memory-mapped recording. nothing is read until read() is called
+class BrainVisionRecording:
+    def __init__(self, vhdrPath, rename = {}):
+        self.header = readHeader(vhdrPath)
+        self.chNames = [rename.get(ch, ch) for ch in self.header["chNames"]]
+        self.sfreq = self.header["sfreq"]
+        self.markers = readMarkers(self.header["markerFile"])
+
+        data = np.memmap(self.header["dataFile"], dtype = self.header["dtype"], mode = "r")
+        nChannels = self.header["nChannels"]
+        self.nTimes = len(data) // nChannels
+
+        #samples x channels (MULTIPLEXED) or channels x samples (VECTORIZED)
+        if self.header["orientation"] == "VECTORIZED":
+            self.data = data[:self.nTimes * nChannels].reshape(nChannels, self.nTimes)
+        else:
+            self.data = data[:self.nTimes * nChannels].reshape(self.nTimes, nChannels).T
+
+    #channels x samples in volts (float64), for picks only
+    def read(self, start, stop, picks = None):
+        if picks is None:
+            picks = np.arange(self.header["nChannels"])
+
+        block = np.asarray(self.data[picks, start:stop], dtype = np.float64)
+
+        return block * self.header["scales"][picks, np.newaxis]
+
+    #[start - pad, stop + pad), padded past the ends the same way MNE does
+    #("reflect_limited" = point reflection around the end sample, then zeros).
+    #end = where the recording is treated as ending (default: all of it)
+    def readReflected(self, start, stop, pad, picks = None, end = None):
+        n = self.nTimes if end is None else end
+        data = self.read(max(start - pad, 0), min(stop + pad, n), picks)
+
+        blocks = [data]
+        if start - pad < 0:
+            nLeft = pad - start
+            first = self.read(0, 1, picks)
+            left = 2 * first - self.read(1, min(1 + nLeft, n), picks)[:, ::-1]
+            blocks.insert(0, np.pad(left, ((0, 0), (nLeft - left.shape[1], 0))))
+
+        if stop + pad > n:
+            nRight = stop + pad - n
+            last = self.read(n - 1, n, picks)
+            right = 2 * last - self.read(max(n - 1 - nRight, 0), n - 1, picks)[:, ::-1]
+            blocks.append(np.pad(right, ((0, 0), (0, nRight - right.shape[1]))))
+
+        return np.concatenate(blocks, axis = 1) if len(blocks) > 1 else data
+
+#chunks (channels x samples, volts) across one or more recordings
+def recordingChunks(recordings, picks = None, chunkSeconds = 60):
+    for recording in recordings:
+        chunk = int(chunkSeconds * recording.sfreq)
+        for start in range(0, recording.nTimes, chunk):
+            yield recording.read(start, min(start + chunk, recording.nTimes), picks)
+
+#writes float32 BrainVision files one chunk at a time
+class BrainVisionWriter:
+    def __init__(self, vhdrPath, chNames, sfreq):
+        self.vhdrPath = vhdrPath
+        self.chNames = chNames
+        self.sfreq = sfreq
+        self.nTimes = 0
+        self.markers = []
+
+        base = path.splitext(vhdrPath)[0]
+        self.dataFile = base + ".eeg"
+        self.markerFile = base + ".vmrk"
+        self.f = open(self.dataFile, "wb")
+
+    #chunk = channels x samples in volts
+    def write(self, chunk):
+        #stored in µV so the header resolution can stay 1
+        self.f.write(np.ascontiguousarray((chunk * 1e6).T, dtype = "<f4").tobytes())
+        self.nTimes += chunk.shape[1]
+
+    #markers = [type, description, position (0-based), size]
+    def addMarkers(self, markers, offset = 0):
+        for m in markers:
+            self.markers.append([m[0], m[1], m[2] + offset, m[3]])
+
+    def close(self):
+        self.f.close()
+
+        dataName = path.basename(self.dataFile)
+        markerName = path.basename(self.markerFile)
+
+        with open(self.vhdrPath, "w", encoding = "utf-8") as f:
+            f.write("Brain Vision Data Exchange Header File Version 1.0\n\n")
+            f.write("[Common Infos]\nCodepage=UTF-8\n")
+            f.write("DataFile=" + dataName + "\nMarkerFile=" + markerName + "\n")
+            f.write("DataFormat=BINARY\nDataOrientation=MULTIPLEXED\n")
+            f.write("NumberOfChannels=" + str(len(self.chNames)) + "\n")
+            f.write("SamplingInterval=" + repr(1e6 / self.sfreq) + "\n\n")
+            f.write("[Binary Infos]\nBinaryFormat=IEEE_FLOAT_32\n\n")
+            f.write("[Channel Infos]\n")
+            for i, ch in enumerate(self.chNames):
+                f.write("Ch{}={},,1,µV\n".format(i + 1, encodeField(ch)))
+
+        with open(self.markerFile, "w", encoding = "utf-8") as f:
+            f.write("Brain Vision Data Exchange Marker File, Version 1.0\n\n")
+            f.write("[Common Infos]\nCodepage=UTF-8\nDataFile=" + dataName + "\n\n")
+            f.write("[Marker Infos]\n")
+            for i, m in enumerate(self.markers):
+                f.write("Mk{}={},{},{},{},0\n".format(i + 1, encodeField(m[0]), encodeField(m[1]),
+                                                     m[2] + 1, m[3]))
+
+#run a small probe through an MNE step to get the step as out = matrix @ in + offset.
+#works for anything linear per sample (interpolation, referencing, ICA)
+def probeLinearStep(info, step):
+    n = len(info["ch_names"])
+    probe = mne.io.RawArray(np.hstack([np.zeros((n, 1)), np.eye(n)]), info, verbose = False)
+    step(probe)
+
+    out = probe.get_data()
+    offset = out[:, :1]
+
+    return out[:, 1:] - offset, offset
+
+#bad channel interpolation then average reference, as one matrix
+def spatialMatrix(info):
+    def step(probe):
+        probe.interpolate_bads(reset_bads = True, verbose = False)
+        probe.set_eeg_reference(ref_channels = "average", verbose = False)
+
+    matrix, _ = probeLinearStep(info, step)
+
+    return matrix
+
+#applying a fitted ICA, as a matrix + offset
+def icaMatrix(ica, info):
+    return probeLinearStep(info, lambda probe: ica.apply(probe, verbose = False))
+
+#zero-phase FIR (same design as raw.filter) or causal IIR (sos) for a band
+def designFilter(sfreq, lFreq, hFreq, method = "fir"):
+    if method == "iir":
+        iir_params = dict(order = 4, ftype = "butter", output = "sos")
+        return mne.filter.create_filter(None, sfreq, lFreq, hFreq, method = "iir",
+                                        iir_params = iir_params, phase = "forward",
+                                        verbose = False)["sos"]
+
+    return mne.filter.create_filter(None, sfreq, lFreq, hFreq, method = "fir",
+                                    phase = "zero", fir_design = "firwin", verbose = False)
+
+#up/down for polyphase resampling, e.g. 500 -> 250 Hz = (1, 2)
+def resampleFactors(sfreq, newSfreq):
+    ratio = Fraction(newSfreq / sfreq).limit_denominator(1000)
+
+    return ratio.numerator, ratio.denominator
+
+#samples of input needed on each side of a chunk for resample_poly's filter
+#(scipy's default design), rounded up to a whole number of "down"
+def resamplePad(up, down):
+    halfLen = 10 * max(up, down)
+    pad = -(-halfLen // up)
+
+    return -(-pad // down) * down
+
+#one recording through spatial matrix + filter, chunk by chunk, into writer.
+#FIR chunks are read with len(kernel)//2 samples of overlap on each side so
+#the output is the same as filtering the whole thing at once. IIR carries its
+#state from chunk to chunk instead. resample = (up, down) is applied last, with
+#its own overlap of real data (padded past the ends by resample_poly itself,
+#as in MNE), after cutting the recording to a whole number of "down"
+def streamRecording(recording, writer, picks = None, spatial = None, constant = None,
+                    fir = None, sos = None, chunkSeconds = 60, resample = None):
+    pad = len(fir) // 2 if fir is not None else 0
+    nTimes = recording.nTimes
+    resPad = 0
+
+    if resample is not None:
+        #IIR state can't be carried across overlapping chunks
+        if sos is not None:
+            raise ValueError("resample in a separate pass from IIR filtering")
+
+        up, down = resample
+        resPad = resamplePad(up, down)
+        nTimes = nTimes // down * down
+
+    #chunks much longer than the filter, otherwise the overlap dominates
+    chunk = max(int(chunkSeconds * recording.sfreq), 4 * (pad + resPad), 1)
+    if resample is not None:
+        chunk = -(-chunk // down) * down
+
+    zi = None
+    for start in range(0, nTimes, chunk):
+        stop = min(start + chunk, nTimes)
+        readStart = max(start - resPad, 0)
+        data = recording.readReflected(readStart, min(stop + resPad, nTimes), pad, picks, end = nTimes)
+
+        if spatial is not None:
+            data = spatial @ data
+        if constant is not None:
+            data += constant
+
+        if fir is not None:
+            data = oaconvolve(data, fir[np.newaxis, :], mode = "valid", axes = -1)
+
+        if sos is not None:
+            if zi is None:
+                zi = sosfilt_zi(sos)[:, np.newaxis, :] * data[np.newaxis, :, :1]
+            data, zi = sosfilt(sos, data, axis = -1, zi = zi)
+
+        if resample is not None:
+            first = (start - readStart) * up // down
+            data = resample_poly(data, up, down, axis = -1, padtype = "reflect")
+            data = data[:, first:first + (stop - start) * up // down]
+
+        writer.write(data)
+
+#several recordings (split session) one after the other into one output file
+def streamRecordings(recordings, outVhdr, picks = None, spatial = None, constant = None,
+                     fir = None, sos = None, chunkSeconds = 60, resample = None):
+    chNames = recordings[0].chNames if picks is None else [recordings[0].chNames[i] for i in picks]
+    up, down = resample if resample is not None else (1, 1)
+    writer = BrainVisionWriter(outVhdr, chNames, recordings[0].sfreq * up / down)
+
+    for i, recording in enumerate(recordings):
+        if recording.chNames != recordings[0].chNames or recording.sfreq != recordings[0].sfreq:
+            raise ValueError("recordings in a session must have the same channels and sampling rate")
+
+        markers = recording.markers
+        if i > 0:
+            markers = [m for m in markers if m[0] != "New Segment"]
+            markers.insert(0, ["New Segment", "", 0, 1])
+
+        #positions at the new rate, minus any cut off the end
+        if resample is not None:
+            nKeep = recording.nTimes // down * up
+            markers = [[m[0], m[1], int(np.round(m[2] * up / down)), m[3]] for m in markers]
+            markers = [m for m in markers if m[2] < nKeep]
+
+        writer.addMarkers(markers, offset = writer.nTimes)
+        streamRecording(recording, writer, picks, spatial, constant, fir, sos, chunkSeconds, resample)
+
+    writer.close()
+
+    return outVhdr
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat May 11 10:02:13 2024
+
+@author: ambric
+
+TFCE permutation test for the group-level TFRs. Same test (and, for the same
+seed or RandomState, same result) as
+
+    mne.stats.spatio_temporal_cluster_test(X, threshold = dict(start, step),
+                                           tail = 1, adjacency = adjacency,
+                                           n_permutations = n)
+
+with the default F-test, but made for running 1000 permutations over
+freqs x times x channels. Permutations are drawn the way MNE draws them
+(check_random_state(seed).permutation, one per permutation). TFCE weights
+each step by t^h_power * dt, as current MNE does (1.7 uses dt^h_power and
+gives very different scores), so it needs an MNE release that scores TFCE
+this way. Every test first checks that the installed MNE agrees, and stops
+if it doesn't.
+
+    - the adjacency is turned into an edge list once, not per permutation
+    - the permutations are split over worker processes that all read the
+      same data: memory-mapped group tensors (.npy) are mapped again by each
+      worker (the page cache is shared, so no extra copy), and anything in
+      memory (e.g. clusterReduce output) goes into shared memory once
+    - TFCE is computed per permutation by sorting the statistic once: at each
+      threshold, the points above it are a prefix of that order (and so are
+      the edges between them), so every step only labels what is still
+      above threshold, with one vectorized connected-components call and no
+      loop over clusters
+    - optionally (alpha given), permutations run in batches and stop once
+      every point's p-value is clearly below or above alpha (its
+      Clopper-Pearson interval is all on one side). errorRate is split
+      evenly over the checks (one per batch, Bonferroni), so it bounds the
+      chance of a wrong call per point over the whole run. len(H0) is then
+      the number of permutations that were actually run
+    - several tests (e.g. the omnibus F-test over all conditions and every
+      pair after it) can share the same permutations: each one is drawn
+      once and scored in every test (tfceMultiTest)
+"""
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools import combinations
+from multiprocessing import shared_memory
+from os import cpu_count
+
+from mne.stats import f_oneway
+from mne.utils import check_random_state
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.stats import beta
+
+#what each worker process needs, set once by _initWorker
+_shared = {}
+
+#adjacency (e.g. from mne.stats.combine_adjacency) -> each edge once,
+#2 x edges, no self-loops
+def adjacencyEdges(adjacency, nTests):
+    if adjacency.shape != (nTests, nTests):
+        raise ValueError("adjacency is {}, needs to be {} (use combine_adjacency)".format(
+            adjacency.shape, (nTests, nTests)))
+
+    adjacency = sparse.coo_array(adjacency)
+    row, col = adjacency.row, adjacency.col
+    keep = row != col
+    pairs = np.unique(np.sort(np.array([row[keep], col[keep]]), axis = 0), axis = 1)
+
+    return pairs.astype(np.int64)
+
+#TFCE score of every point (as MNE's _find_clusters, tail = 1):
+#sum over thresholds t < stat of t^h_power * dt * (cluster size)^e_power
+def tfceScores(stat, edges, threshold):
+    hPower = threshold.get("h_power", 2)
+    ePower = threshold.get("e_power", .5)
+
+    finite = np.isfinite(stat)
+    if not finite.any():
+        raise RuntimeError("No finite values found in the observed statistic values")
+    thresholds = np.arange(threshold["start"], stat[finite].max(), threshold["step"], float)
+
+    #points from highest to lowest stat, edges by when both ends are in
+    order = np.argsort(-np.where(finite, stat, -np.inf), kind = "stable")
+    rank = np.empty(len(stat), dtype = np.int64)
+    rank[order] = np.arange(len(stat))
+    descending = -stat[order][:finite.sum()]
+
+    rankEdges = rank[edges]
+    joins = rankEdges.max(axis = 0)
+    edgeOrder = np.argsort(joins, kind = "stable")
+    rankEdges = rankEdges[:, edgeOrder]
+    joins = joins[edgeOrder]
+
+    scores = np.zeros(len(stat))
+    for ti, thresh in enumerate(thresholds):
+        nActive = np.searchsorted(descending, -thresh, side = "left")
+        if nActive == 0:
+            break
+
+        dh = abs(thresh) if ti == 0 else abs(thresh - thresholds[ti - 1])
+        h = abs(thresh) ** hPower * dh
+
+        nEdges = np.searchsorted(joins, nActive, side = "left")
+        graph = sparse.coo_array((np.ones(nEdges, dtype = np.int8), tuple(rankEdges[:, :nEdges])),
+                                 shape = (nActive, nActive))
+        _, labels = connected_components(graph, directed = False)
+
+        scores[:nActive] += h * np.bincount(labels)[labels] ** ePower
+
+    return scores[rank]
+
+#each test's samples, as (member = which of all samples are in its
+#conditions, slices of its conditions within those). a permutation of all
+#samples, restricted to the members (order kept), is a uniform permutation of
+#just those, so every test can share the same draws
+def testSamples(tests, sizes):
+    bounds = np.cumsum([0] + list(sizes))
+
+    samples = []
+    for conditions in tests:
+        member = np.zeros(bounds[-1], dtype = bool)
+        for c in conditions:
+            member[bounds[c]:bounds[c + 1]] = True
+
+        testBounds = np.cumsum([0] + [sizes[c] for c in conditions])
+        samples.append((member, [slice(start, stop) for start, stop in zip(testBounds[:-1], testBounds[1:])]))
+
+    return samples
+
+#(.npy file, first row) of a C-contiguous view into a memory-mapped .npy
+#(e.g. the group tensors), else None
+def npySource(x):
+    if not isinstance(x, np.memmap) or x.filename is None or not x.flags.c_contiguous:
+        return None
+
+    root = x
+    while isinstance(root.base, np.ndarray):
+        root = root.base
+
+    rowBytes = x.strides[0] if x.ndim else 0
+    offset = x.__array_interface__["data"][0] - root.__array_interface__["data"][0]
+    if rowBytes == 0 or offset % rowBytes or root.shape[1:] != x.shape[1:]:
+        return None
+
+    return x.filename, offset // rowBytes
+
+#sources = ("npy", [(file, first row, rows) per condition]) or
+#("shm", shared memory name, shape, dtype) with all conditions in one block
+#whether the installed MNE scores TFCE the way tfceScores does (checked once,
+#on a two-point example where the two ways differ)
+_mneAgrees = {}
+
+def checkMNETFCE():
+    if "agrees" not in _mneAgrees:
+        from mne import __version__
+        from mne.stats.cluster_level import _find_clusters
+
+        stat = np.array([1., .5])
+        threshold = dict(start = 0, step = .4)
+        _, mneScores = _find_clusters(stat, threshold, tail = 1)
+        ours = tfceScores(stat, adjacencyEdges(sparse.coo_array(([1], ([0], [1])), shape = (2, 2)), 2), threshold)
+
+        _mneAgrees["agrees"] = np.allclose(mneScores, ours)
+        _mneAgrees["version"] = __version__
+
+    if not _mneAgrees["agrees"]:
+        raise RuntimeError("MNE {} computes TFCE differently (dt^h_power, as in MNE 1.7), so results wouldn't "
+                           "match spatio_temporal_cluster_test. Update MNE (e.g. 1.13 agrees).".format(_mneAgrees["version"]))
+
+def _initWorker(sources, samples, edges, threshold, statFun):
+    if sources[0] == "npy":
+        parts = [np.load(f, mmap_mode = "r")[first:first + n].reshape(n, -1) for f, first, n in sources[1]]
+    else:
+        memory = shared_memory.SharedMemory(name = sources[1])
+        _shared["memory"] = memory
+        parts = [np.ndarray(sources[2], dtype = sources[3], buffer = memory.buf)]
+
+    #condition + row of every sample (all conditions one after the other)
+    sizes = [len(part) for part in parts]
+    _shared.update(parts = parts, sampleCondition = np.repeat(np.arange(len(parts)), sizes),
+                   sampleRow = np.concatenate([np.arange(n) for n in sizes]), samples = samples, edges = edges,
+                   threshold = threshold, statFun = statFun)
+
+#rows of these samples (indices into all conditions one after the other)
+def _takeSamples(inds):
+    parts = _shared["parts"]
+    if len(parts) == 1:
+        return parts[0][inds]
+
+    condition = _shared["sampleCondition"][inds]
+    row = _shared["sampleRow"][inds]
+
+    out = np.empty((len(inds), parts[0].shape[1]), dtype = np.result_type(*parts))
+    for c, part in enumerate(parts):
+        mask = condition == c
+        if mask.any():
+            out[mask] = part[row[mask]]
+
+    return out
+
+#max TFCE score of each permutation (orders = rows of sample indices) for
+#every test, permutations x tests
+def _permutationMaxima(orders):
+    maxima = np.empty((len(orders), len(_shared["samples"])))
+    for i, order in enumerate(orders):
+        for t, (member, slices) in enumerate(_shared["samples"]):
+            testOrder = order[member[order]]
+            stat = _shared["statFun"](*[_takeSamples(testOrder[s]) for s in slices])
+            maxima[i, t] = tfceScores(stat, _shared["edges"], _shared["threshold"]).max()
+
+    return maxima
+
+#points whose p-value (exceedances out of nDraws) can still be on either side
+#of alpha: Clopper-Pearson interval at errorRate (two-sided) around it
+def undecided(exceedances, nDraws, alpha, errorRate):
+    exceedances = np.asarray(exceedances, dtype = float)
+    lower = np.where(exceedances > 0,
+                     beta.ppf(errorRate / 2, exceedances, nDraws - exceedances + 1), 0)
+    upper = np.where(exceedances < nDraws,
+                     beta.ppf(1 - errorRate / 2, exceedances + 1, nDraws - exceedances), 1)
+
+    return (lower < alpha) & (upper >= alpha)
+
+#the omnibus test over all nConditions, then every pair (as tfceMultiTest tests)
+def omnibusTests(nConditions):
+    return [tuple(range(nConditions))] + list(combinations(range(nConditions), 2))
+
+#X = list of (subjects x freqs x times x channels) arrays, one per condition,
+#adjacency over all freqs x times x channels (combine_adjacency), tests = the
+#conditions (indices into X) compared in each test.
+#returns (F_obs (TFCE-scored), clusters (one per point), p-values, H0), like
+#spatio_temporal_cluster_test, for every test. every permutation is drawn
+#once and scored in every test, and each test gets its own H0. with alpha,
+#stops early (in batches of batchSize) once no p-value in any test can still
+#land on the other side of alpha (errorRate over all the checks together)
+def tfceMultiTest(X, adjacency, tests, nPermutations = 1000, threshold = dict(start = 0, step = .2), rng = None,
+                  nWorkers = None, statFun = f_oneway, alpha = None, errorRate = .001, batchSize = 100):
+    if not isinstance(threshold, dict):
+        raise TypeError("threshold must be a dict (TFCE), e.g. dict(start = 0, step = 0.2)")
+    checkMNETFCE()
+    if alpha is not None and not 0 < errorRate < 1:
+        raise ValueError("errorRate must be between 0 and 1, got {}".format(errorRate))
+    if any(len(conditions) < 2 or not set(conditions) <= set(range(len(X))) for conditions in tests):
+        raise ValueError("Every test needs 2+ of the {} conditions in X, got {}".format(len(X), tests))
+
+    sampleShape = X[0].shape[1:]
+    if any(x.shape[1:] != sampleShape for x in X):
+        raise ValueError("All conditions need the same freqs x times x channels")
+
+    #workers map the .npy files themselves if every condition has one
+    npySources = [npySource(x) for x in X]
+    if any(source is None for source in npySources):
+        npySources = None
+
+    X = [np.reshape(x, (len(x), -1)) for x in X]
+    nTests = X[0].shape[1]
+    edges = adjacencyEdges(adjacency, nTests)
+
+    #observed
+    stats = [statFun(*[X[c] for c in conditions]) for conditions in tests]
+    scores = [tfceScores(stat, edges, threshold) for stat in stats]
+
+    #same draws as MNE for the same seed/RandomState (all drawn, even if we stop
+    #early, so the ones that do run are the same ones MNE would run first)
+    rng = check_random_state(rng)
+    nSamples = sum(len(x) for x in X)
+    orders = np.array([rng.permutation(nSamples) for _ in range(nPermutations - 1)]).reshape(-1, nSamples)
+
+    samples = testSamples(tests, [len(x) for x in X])
+
+    if nWorkers is None:
+        nWorkers = cpu_count()
+    nWorkers = max(min(nWorkers, len(orders)), 1)
+
+    #everything at once, or batch by batch when stopping early
+    if alpha is None:
+        batches = [orders]
+    else:
+        batches = np.array_split(orders, np.arange(batchSize, len(orders), batchSize))
+
+    #error budget per check (one check per batch)
+    checkErrorRate = errorRate / max(len(batches), 1)
+
+    #the observed max counts as one of the permutations
+    H0 = [np.array([[score.max() for score in scores]])]
+
+    #in-memory data: all conditions, one after the other, in shared memory
+    memory = None
+    if npySources is not None:
+        sources = ("npy", [(f, first, len(x)) for (f, first), x in zip(npySources, X)])
+    else:
+        dtype = np.result_type(*X)
+        memory = shared_memory.SharedMemory(create = True, size = max(nSamples * nTests * dtype.itemsize, 1))
+        sources = ("shm", memory.name, (nSamples, nTests), dtype)
+
+    try:
+        if memory is not None:
+            XFull = np.ndarray((nSamples, nTests), dtype = dtype, buffer = memory.buf)
+            start = 0
+            for x in X:
+                XFull[start:start + len(x)] = x
+                start += len(x)
+            del XFull
+
+        with ProcessPoolExecutor(max_workers = nWorkers, initializer = _initWorker,
+                                 initargs = (sources, samples, edges, threshold, statFun)) as pool:
+            for batch in batches:
+                if len(batch) == 0:
+                    continue
+                H0 += list(pool.map(_permutationMaxima, np.array_split(batch, min(nWorkers * 4, len(batch)))))
+
+                if alpha is not None:
+                    sortedH0 = np.sort(np.concatenate(H0), axis = 0)
+                    if not any(undecided(len(sortedH0) - np.searchsorted(sortedH0[:, t], score, side = "left"),
+                                         len(sortedH0), alpha, checkErrorRate).any() for t, score in enumerate(scores)):
+                        break
+    finally:
+        if memory is not None:
+            memory.close()
+            memory.unlink()
+
+    H0 = np.concatenate(H0)
+
+    results = []
+    for t, (stat, score) in enumerate(zip(stats, scores)):
+        sortedH0 = np.sort(H0[:, t])
+        pValues = (len(H0) - np.searchsorted(sortedH0, score, side = "left")) / len(H0)
+
+        FObs = (score * np.sign(stat)).reshape(sampleShape)
+        clusters = [np.unravel_index(np.array([i]), sampleShape) for i in range(nTests)]
+
+        results.append((FObs, clusters, pValues, H0[:, t].copy()))
+
+    return results
+
+#one test over all conditions in X (see tfceMultiTest)
+def tfceClusterTest(X, adjacency, nPermutations = 1000, threshold = dict(start = 0, step = .2), rng = None,
+                    nWorkers = None, statFun = f_oneway, alpha = None, errorRate = .001, batchSize = 100):
+    return tfceMultiTest(X, adjacency, [tuple(range(len(X)))], nPermutations, threshold, rng, nWorkers, statFun,
+                         alpha, errorRate, batchSize)[0]
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun May 12 09:40:05 2024
+
+@author: ambric
+
+Figures for the significant clusters of the group test (topomap of the
+averaged F-map + spectrogram, as in groupLevel_allSensors.py), without a
+screen: every cluster is drawn by a worker process with the Agg backend and
+saved as .png/.svg.
+
+The test results go to disk next to the figures (stats.npz, the channel
+info and a clusters.json summary: channels, time/frequency range, peak F and
+p-value per cluster), so the figures and reports can be made again with
+loadClusterResults() without rerunning the permutations.
+"""
+import json
+import matplotlib.pyplot as plt
+import mne
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from os import cpu_count, makedirs, path
+from mpl_toolkits.axes_grid1 import make_axes_locatable
+
+#what each worker process needs, set once by _initWorker
+_shared = {}
+
+#topomap + spectrogram of one cluster (number = 1, 2, . . . in the titles)
+#taken from: https://mne.tools/stable/auto_tutorials/stats-sensor-space/75_cluster_ftest_spatiotemporal.html
+def plotCluster(number, cluster, F_obs, info, times, freqs):
+    # unpack cluster information, get unique indices
+    freq_inds, time_inds, space_inds = cluster
+    ch_inds = np.unique(space_inds)
+    time_inds = np.unique(time_inds)
+    freq_inds = np.unique(freq_inds)
+
+    # get topography for F stat
+    f_map = F_obs[freq_inds].mean(axis=0)
+    f_map = f_map[time_inds].mean(axis=0)
+
+    # get signals at the sensors contributing to the cluster
+    sig_times = times[time_inds]
+
+    # initialize figure
+    fig, ax_topo = plt.subplots(1, 1, figsize=(10, 3))
+
+    # create spatial mask
+    mask = np.zeros((f_map.shape[0], 1), dtype=bool)
+    mask[ch_inds, :] = True
+
+    # plot average test statistic and mark significant sensors
+    f_evoked = mne.EvokedArray(f_map[:, np.newaxis], info, tmin=0)
+    f_evoked.plot_topomap(times=0, mask=mask, axes=ax_topo, cmap='Reds',
+                          vlim=(np.min, np.max), show=False, colorbar=False,
+                          mask_params=dict(markersize=10))
+    image = ax_topo.images[0]
+
+    # create additional axes (for ERF and colorbar)
+    divider = make_axes_locatable(ax_topo)
+
+    # add axes for colorbar
+    ax_colorbar = divider.append_axes('right', size='5%', pad=0.05)
+    plt.colorbar(image, cax=ax_colorbar)
+    ax_topo.set_xlabel(
+        'Averaged F-map ({:0.3f} - {:0.3f} s)'.format(*sig_times[[0, -1]]))
+
+    # remove the title that would otherwise say "0.000 s"
+    ax_topo.set_title("")
+
+    # add new axis for spectrogram
+    ax_spec = divider.append_axes('right', size='300%', pad=1.2)
+    title = 'Cluster #{0}, {1} spectrogram'.format(number, len(ch_inds))
+    if len(ch_inds) > 1:
+        title += " (max over channels)"
+    F_obs_plot = F_obs[..., ch_inds].max(axis=-1)
+    F_obs_plot_sig = np.zeros(F_obs_plot.shape) * np.nan
+    F_obs_plot_sig[tuple(np.meshgrid(freq_inds, time_inds))] = \
+        F_obs_plot[tuple(np.meshgrid(freq_inds, time_inds))]
+
+    for f_image, cmap in zip([F_obs_plot, F_obs_plot_sig], ['gray', 'autumn']):
+        c = ax_spec.imshow(f_image, cmap=cmap, aspect='auto', origin='lower',
+                           extent=[times[0], times[-1],
+                                   freqs[0], freqs[-1]])
+    ax_spec.set_xlabel('Time (s)')
+    ax_spec.set_ylabel('Frequency (Hz)')
+    ax_spec.set_title(title)
+
+    # add another colorbar
+    ax_colorbar2 = divider.append_axes('right', size='5%', pad=0.05)
+    plt.colorbar(c, cax=ax_colorbar2)
+    ax_colorbar2.set_ylabel('F-stat')
+
+    # clean up viz
+    mne.viz.tight_layout(fig=fig)
+    fig.subplots_adjust(bottom=.05)
+
+    return fig
+
+#channels, time + frequency range, peak F and p-value of each cluster in inds
+#(chNames = names along the last axis: channels, or ROIs)
+def clusterSummary(F_obs, clusters, p_values, inds, chNames, times, freqs):
+    summary = []
+    for number, ind in enumerate(inds, 1):
+        freq_inds, time_inds, space_inds = clusters[ind]
+        peak = np.argmax(F_obs[freq_inds, time_inds, space_inds])
+
+        summary.append({"cluster" : number, "index" : int(ind), "p" : float(p_values[ind]),
+                        "channels" : [chNames[i] for i in np.unique(space_inds)],
+                        "time" : [float(times[time_inds].min()), float(times[time_inds].max())],
+                        "freq" : [float(freqs[freq_inds].min()), float(freqs[freq_inds].max())],
+                        "peakF" : float(F_obs[freq_inds, time_inds, space_inds][peak]),
+                        "peakAt" : {"time" : float(times[time_inds[peak]]), "freq" : float(freqs[freq_inds[peak]]),
+                                    "channel" : chNames[space_inds[peak]]},
+                        "size" : int(len(space_inds))})
+
+    return summary
+
+#F_obs, p-values, the clusters in inds (as flat indices), times, freqs,
+#channel info and the summary into outPath. info can be None if the last axis
+#isn't channels (e.g. ROIs), with their names in chNames
+def saveClusterResults(outPath, F_obs, clusters, p_values, inds, info, times, freqs, chNames = None):
+    makedirs(outPath, exist_ok = True)
+    if chNames is None:
+        chNames = info["ch_names"]
+
+    flat = [np.ravel_multi_index(clusters[ind], F_obs.shape) for ind in inds]
+    np.savez(path.join(outPath, "stats.npz"), F_obs = F_obs, p_values = p_values, inds = np.asarray(inds, dtype = int),
+             clusterPoints = np.concatenate(flat) if flat else np.zeros(0, dtype = int),
+             clusterBounds = np.cumsum([0] + [len(f) for f in flat]), times = times, freqs = freqs,
+             chNames = np.array(chNames))
+    if info is not None:
+        mne.io.write_info(path.join(outPath, "stats-info.fif"), info)
+
+    summary = clusterSummary(F_obs, clusters, p_values, inds, chNames, times, freqs)
+    with open(path.join(outPath, "clusters.json"), "w") as f:
+        json.dump(summary, f, indent = 1)
+
+    return summary
+
+#what saveClusterResults wrote: F_obs, clusters (only the saved ones are
+#filled in), p_values, inds, info (None if not saved), times, freqs
+def loadClusterResults(outPath):
+    stats = np.load(path.join(outPath, "stats.npz"))
+    F_obs = stats["F_obs"]
+    bounds = stats["clusterBounds"]
+
+    clusters = [None] * len(stats["p_values"])
+    for ind, start, stop in zip(stats["inds"], bounds[:-1], bounds[1:]):
+        clusters[ind] = np.unravel_index(stats["clusterPoints"][start:stop], F_obs.shape)
+
+    info = None
+    if path.isfile(path.join(outPath, "stats-info.fif")):
+        info = mne.io.read_info(path.join(outPath, "stats-info.fif"), verbose = False)
+
+    return F_obs, clusters, stats["p_values"], stats["inds"], info, stats["times"], stats["freqs"]
+
+def _initWorker(F_obs, info, times, freqs, outPath, formats):
+    mne.set_log_level("WARNING")
+    plt.switch_backend("Agg")
+    _shared.update(F_obs = F_obs, info = info, times = times, freqs = freqs, outPath = outPath, formats = formats)
+
+#draw + save one cluster, returns the files
+def _renderCluster(number, cluster):
+    fig = plotCluster(number, cluster, _shared["F_obs"], _shared["info"], _shared["times"], _shared["freqs"])
+
+    files = []
+    for fmt in _shared["formats"]:
+        files.append(path.join(_shared["outPath"], "cluster_{:03d}.{}".format(number, fmt)))
+        fig.savefig(files[-1], dpi = 150)
+    plt.close(fig)
+
+    return files
+
+#every cluster in inds to outPath (one file per format, numbered in order) +
+#the results/summary (saveClusterResults). returns the summary
+def renderClusters(outPath, F_obs, clusters, p_values, inds, info, times, freqs, formats = ("png",),
+                   nWorkers = None):
+    summary = saveClusterResults(outPath, F_obs, clusters, p_values, inds, info, times, freqs)
+    if not len(inds):
+        return summary
+
+    if nWorkers is None:
+        nWorkers = cpu_count()
+
+    with ProcessPoolExecutor(max_workers = max(min(nWorkers, len(inds)), 1), initializer = _initWorker,
+                             initargs = (F_obs, info, times, freqs, outPath, formats)) as pool:
+        for entry, files in zip(summary, pool.map(_renderCluster, range(1, len(inds) + 1),
+                                                  [clusters[ind] for ind in inds])):
+            entry["files"] = files
+
+    with open(path.join(outPath, "clusters.json"), "w") as f:
+        json.dump(summary, f, indent = 1)
+
+    return summary
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun May 12 14:22:51 2024
+
+@author: ambric
+
+Smaller version of the group data for quick, exploratory cluster tests:
+freqs averaged into bands (theta/alpha/beta), channels averaged into ROIs,
+and time averaged into bins of a given length. Each of the three is optional.
+The adjacency for the reduced data is rebuilt to match (neighbouring bands,
+neighbouring time bins, ROIs that share at least one pair of neighbouring
+channels), ready for clusterEngine.
+
+The full-resolution test is still the one to report. This is for finding
+out where to look in minutes instead of hours.
+"""
+import mne
+import numpy as np
+
+from scipy import sparse
+
+#canonical bands (Hz, [low, high)). freqs outside every band are left out
+canonicalBands = {"theta" : (4, 8), "alpha" : (8, 13), "beta" : (13, 30)}
+
+#rows = groups, columns = the indices they average over (each row sums to 1)
+def _averaging(groups, n):
+    rows = np.concatenate([np.full(len(g), i) for i, g in enumerate(groups)])
+    cols = np.concatenate(groups)
+    weights = np.concatenate([np.full(len(g), 1 / len(g)) for g in groups])
+
+    return sparse.csr_array((weights, (rows, cols)), shape = (len(groups), n))
+
+#freq indices in each band, leaving out bands with none
+def bandGroups(freqs, bands):
+    groups = {name : np.flatnonzero((freqs >= low) & (freqs < high)) for name, (low, high) in bands.items()}
+
+    return {name : inds for name, inds in groups.items() if len(inds)}
+
+#channel indices in each ROI. every channel has to be in info
+def roiGroups(chNames, rois):
+    missing = sorted({ch for chs in rois.values() for ch in chs} - set(chNames))
+    if missing:
+        raise ValueError("ROI channels not in the data: {}".format(missing))
+
+    return {name : np.array([chNames.index(ch) for ch in chs]) for name, chs in rois.items() if len(chs)}
+
+#consecutive samples in bins of (about) timeStep s
+def timeGroups(times, timeStep):
+    binSize = max(int(np.round(timeStep / (times[1] - times[0]))), 1) if len(times) > 1 else 1
+
+    return [np.arange(start, min(start + binSize, len(times))) for start in range(0, len(times), binSize)]
+
+#ROIs neighbours if any of their channels are (channel adjacency from
+#find_ch_adjacency). a csr_matrix, like find_ch_adjacency gives, since older
+#MNE (e.g. 1.7) combine_adjacency only takes sparse matrices, not arrays
+def roiAdjacency(chAdjacency, groups):
+    membership = (_averaging(groups, chAdjacency.shape[0]) > 0).astype(int)
+    adjacency = (membership @ sparse.csr_array(chAdjacency) @ membership.T > 0).astype(int)
+    adjacency.setdiag(0)
+    adjacency.eliminate_zeros()
+
+    return sparse.csr_matrix(adjacency)
+
+#X = list of (subjects x freqs x times x channels) arrays (e.g. the memmapped
+#group tensors), read once, reduced into memory. bands = {name : (low, high)},
+#rois = {name : [channels]}, timeStep = s, any of them None = keep as is.
+#returns the reduced X, adjacency (for clusterEngine) and the labels of each
+#axis (band centers/freqs + band names, bin centers/times, ROI/channel names)
+def reduceGroup(X, freqs, times, chNames, chAdjacency, bands = None, rois = None, timeStep = None):
+    freqs = np.asarray(freqs)
+    times = np.asarray(times)
+
+    bandInds = bandGroups(freqs, bands) if bands else {}
+    roiInds = roiGroups(chNames, rois) if rois else {}
+    if bands and not bandInds:
+        raise ValueError("None of the freqs {} are in the bands {}".format(np.round(freqs, 2), bands))
+
+    freqInds = list(bandInds.values()) if bands else [np.array([i]) for i in range(len(freqs))]
+    timeInds = timeGroups(times, timeStep) if timeStep else [np.array([i]) for i in range(len(times))]
+    chInds = list(roiInds.values()) if rois else [np.array([i]) for i in range(len(chNames))]
+
+    F = _averaging(freqInds, len(freqs))
+    T = _averaging(timeInds, len(times)).toarray()
+    C = _averaging(chInds, len(chNames)).toarray()
+
+    reduced = []
+    for x in X:
+        out = np.empty((len(x), len(freqInds), len(timeInds), len(chInds)), dtype = np.float32)
+        for s, subject in enumerate(x):
+            #freqs x times x channels -> bands x bins x ROIs, one subject in memory at a time
+            subject = np.asarray(subject, dtype = np.float64)
+            subject = (F @ subject.reshape(len(freqs), -1)).reshape(len(freqInds), len(times), len(chNames))
+            subject = np.einsum("bt,ftc->fbc", T, subject)
+            out[s] = subject @ C.T
+        reduced.append(out)
+
+    spatial = roiAdjacency(chAdjacency, chInds) if rois else chAdjacency
+    adjacency = mne.stats.combine_adjacency(len(freqInds), len(timeInds), spatial)
+
+    labels = {"freqs" : np.array([freqs[inds].mean() for inds in freqInds]),
+              "bands" : list(bandInds) if bands else None,
+              "times" : np.array([times[inds].mean() for inds in timeInds]),
+              "chNames" : list(roiInds) if rois else list(chNames)}
+
+    return reduced, adjacency, labels
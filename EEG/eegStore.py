@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Apr 21 10:33:09 2024
+
+@author: ambric
+
+Compact output format for cleaned EEG: one HDF5 file per subject with the data
+as float32, chunked along time and compressed, plus the channel info and
+annotations needed to rebuild the events.
+
+Because the data are chunked along time, epoching only has to read (and
+decompress) the windows around events instead of the whole recording.
+
+Needs h5py (pip install h5py).
+"""
+import h5py
+import mne
+import numpy as np
+import re
+
+#cleaned data -> .h5. rawData doesn't need to be preloaded (read a chunk at a time)
+def saveStore(rawData, filePath, chunkSeconds = 10, compression = "gzip", level = 4):
+    sfreq = rawData.info["sfreq"]
+    nChannels = len(rawData.ch_names)
+    chunk = min(int(chunkSeconds * sfreq), rawData.n_times)
+
+    with h5py.File(filePath, "w") as f:
+        data = f.create_dataset("data", shape = (nChannels, rawData.n_times), dtype = "<f4",
+                                chunks = (nChannels, chunk), compression = compression,
+                                compression_opts = level, shuffle = True)
+
+        for start in range(0, rawData.n_times, chunk):
+            stop = min(start + chunk, rawData.n_times)
+            data[:, start:stop] = rawData.get_data(start = start, stop = stop)
+
+        #channel info
+        f.attrs["sfreq"] = sfreq
+        f.attrs["first_samp"] = rawData.first_samp
+        f.attrs["highpass"] = rawData.info["highpass"]
+        f.attrs["lowpass"] = rawData.info["lowpass"]
+        f.attrs["ch_names"] = rawData.ch_names
+        f.attrs["ch_types"] = rawData.get_channel_types()
+        f.attrs["bads"] = list(rawData.info["bads"])
+        f["ch_pos"] = np.array([ch["loc"][:3] for ch in rawData.info["chs"]])
+
+        #annotations, onsets in seconds from the first sample
+        annotations = rawData.annotations
+
+        group = f.create_group("annotations")
+        group["onset"] = annotations.onset - rawData.first_time
+        group["duration"] = annotations.duration
+        group["description"] = np.array(annotations.description, dtype = h5py.string_dtype())
+
+    return filePath
+
+#read side. only opens the file; data are read per window
+class EEGStore:
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.f = h5py.File(filePath, "r")
+        self.data = self.f["data"]
+
+        attrs = self.f.attrs
+        self.sfreq = float(attrs["sfreq"])
+        self.firstSamp = int(attrs["first_samp"])
+        self.chNames = [str(ch) for ch in attrs["ch_names"]]
+        self.nTimes = self.data.shape[1]
+
+        self.info = mne.create_info(self.chNames, self.sfreq, [str(t) for t in attrs["ch_types"]])
+        positions = self.f["ch_pos"][()]
+        if np.isfinite(positions).all() and np.any(positions):
+            montage = mne.channels.make_dig_montage(dict(zip(self.chNames, positions)), coord_frame = "head")
+            self.info.set_montage(montage)
+        with self.info._unlock():
+            self.info["highpass"] = float(attrs["highpass"])
+            self.info["lowpass"] = float(attrs["lowpass"])
+        self.info["bads"] = [str(ch) for ch in attrs["bads"]]
+
+        group = self.f["annotations"]
+        self.onsets = group["onset"][()]
+        self.durations = group["duration"][()]
+        self.descriptions = [d.decode() if isinstance(d, bytes) else str(d) for d in group["description"][()]]
+
+    def close(self):
+        self.f.close()
+
+    #channels x samples in volts, for a range of samples (from the first sample)
+    def read(self, start, stop):
+        return self.data[:, start:stop].astype(np.float64)
+
+    #whole recording as a Raw (only when everything is needed)
+    def toRaw(self):
+        rawData = mne.io.RawArray(self.read(0, self.nTimes), self.info, first_samp = self.firstSamp)
+        rawData.set_annotations(mne.Annotations(self.onsets, self.durations, self.descriptions))
+
+        return rawData
+
+    #same as mne.events_from_annotations(raw, event_id = mapper, regexp = regexp):
+    #mapper(description) -> int, or None to skip. by default (as in MNE) BAD
+    #and EDGE annotations, e.g. the boundaries of appended recordings, aren't
+    #events and never reach mapper. regexp = None = every annotation
+    def events(self, mapper, regexp = r"^(?![Bb][Aa][Dd]|[Ee][Dd][Gg][Ee]).*$"):
+        pattern = re.compile(regexp) if regexp is not None else None
+
+        events = []
+        for onset, description in zip(self.onsets, self.descriptions):
+            if pattern is not None and not pattern.match(description):
+                continue
+
+            eventID = mapper(description)
+            if eventID is not None:
+                events.append([int(np.round(onset * self.sfreq)) + self.firstSamp, 0, eventID])
+
+        events = np.array(events, dtype = int).reshape(-1, 3)
+
+        return events[np.argsort(events[:, 0], kind = "stable")]
+
+    #like mne.Epochs(raw, events, event_id, tmin, tmax), but only the windows
+    #around the events are read. epochs overlapping BAD annotations or running
+    #off the ends are dropped, and baseline is (None, 0) by default, as in MNE
+    def epochs(self, events, event_id, tmin, tmax, baseline = (None, 0)):
+        startOffset = int(np.round(tmin * self.sfreq))
+        nSamples = int(np.round(tmax * self.sfreq)) - startOffset + 1
+
+        bad = [i for i, d in enumerate(self.descriptions) if d.lower().startswith("bad")]
+        badStarts = np.round(self.onsets[bad] * self.sfreq)
+        badStops = badStarts + np.round(self.durations[bad] * self.sfreq)
+
+        picks = mne.pick_types(self.info, eeg = True, exclude = [])
+
+        keep = []
+        data = []
+        for i, (sample, _, eventID) in enumerate(events):
+            if eventID not in event_id.values():
+                continue
+
+            start = sample - self.firstSamp + startOffset
+            stop = start + nSamples
+            if start < 0 or stop > self.nTimes:
+                continue
+            if np.any((badStarts < stop) & (badStops >= start)):
+                continue
+
+            keep.append(i)
+            data.append(self.data[:, start:stop][picks])
+
+        info = mne.pick_info(self.info, picks)
+        data = np.array(data, dtype = np.float64).reshape(len(keep), len(picks), nSamples)
+
+        #only the conditions that actually have epochs
+        found = set(events[keep, 2])
+        event_id = {k : v for k, v in event_id.items() if v in found}
+
+        return mne.EpochsArray(data, info, events = events[keep], tmin = startOffset / self.sfreq,
+                               event_id = event_id, baseline = baseline, verbose = False)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 30 10:12:31 2024
+
+@author: ambric
+
+Automatic ICA component classification, so picking components doesn't need a
+person sitting in front of plot_sources().
+
+Each component gets a few simple features:
+
+    frontal  = how much bigger its weights are at Fp/AF sites than on average
+    asymmetry = F7 vs F8 weights (saccades flip sign across the head)
+    focal    = how much one channel dominates the topography (muscle)
+    kurtosis = spikiness of the time course (blinks)
+    slope    = log-log slope of the 7-40 Hz spectrum (flat/positive = muscle)
+    VEOG/HEOG = correlation with virtual EOG channels made from Fp1/Fp2 (vertical)
+                and F7/F8 (horizontal), since most recordings have no EOG
+
+Features are turned into 0-1 sub-scores and averaged into a blink, saccade and
+muscle score. A component is excluded if any score is over its threshold.
+Everything gets written to a table so the choices can be checked later.
+
+The fitting itself is also here (decimated data, optional check against a
+full-rate fit).
+"""
+import mne
+import numpy as np
+import pandas as pd
+
+from scipy.optimize import linear_sum_assignment
+from scipy.signal import welch
+from scipy.stats import kurtosis
+from time import perf_counter
+
+#channels used to build features (missing ones are skipped)
+frontalChannels = ("Fp1", "Fpz", "Fp2", "AF3", "AF4", "AF7", "AF8")
+veogChannels = ("Fp1", "Fp2")
+heogChannels = ("F7", "F8")
+
+#exclude a component when its score is over this
+defaultThresholds = {"blink" : .6, "saccade" : .6, "muscle" : .7}
+
+#mean absolute weight over the channels we have
+def meanWeight(topo, chNames, channels):
+    inds = [chNames.index(ch) for ch in channels if ch in chNames]
+    if not inds:
+        return np.zeros(topo.shape[1])
+
+    return np.abs(topo[inds]).mean(axis = 0)
+
+#|correlation| of every source with one signal
+def sourceCorrelation(sources, signal):
+    sources = sources - sources.mean(axis = 1, keepdims = True)
+    signal = signal - signal.mean()
+
+    norm = np.linalg.norm(sources, axis = 1) * np.linalg.norm(signal)
+
+    return np.abs(sources @ signal) / np.where(norm > 0, norm, 1)
+
+#features for every component (one row per component)
+def componentFeatures(ica, dataICA):
+    topo = ica.get_components()
+    chNames = list(ica.ch_names)
+    allWeights = np.abs(topo).mean(axis = 0)
+
+    sources = ica.get_sources(dataICA).get_data()
+    sfreq = dataICA.info["sfreq"]
+
+    features = pd.DataFrame(index = pd.Index(range(topo.shape[1]), name = "component"))
+
+    #topography
+    features["frontal"] = meanWeight(topo, chNames, frontalChannels) / allWeights
+
+    #1 = opposite polarity on the two sides, 0 = same weight on both
+    if all(ch in chNames for ch in heogChannels):
+        left = topo[chNames.index(heogChannels[0])]
+        right = topo[chNames.index(heogChannels[1])]
+        total = np.abs(left) + np.abs(right)
+        features["asymmetry"] = np.abs(left - right) / np.where(total > 0, total, 1)
+    else:
+        features["asymmetry"] = 0.
+
+    features["focal"] = np.abs(topo).max(axis = 0) / allWeights
+
+    #time course
+    features["kurtosis"] = kurtosis(sources, axis = 1)
+
+    freqs, psd = welch(sources, fs = sfreq, nperseg = min(int(2 * sfreq), sources.shape[1]), axis = 1)
+    band = (freqs >= 7) & (freqs <= min(40, sfreq / 2))
+    features["slope"] = np.polyfit(np.log10(freqs[band]), np.log10(psd[:, band].T), 1)[0]
+
+    #virtual EOG from the (1-40 Hz) data the ICA was fitted on
+    names = [ch for ch in veogChannels + heogChannels if ch in dataICA.ch_names]
+    data = dataICA.get_data(picks = names)
+
+    veog = [data[names.index(ch)] for ch in veogChannels if ch in names]
+    features["VEOG"] = sourceCorrelation(sources, np.mean(veog, axis = 0)) if veog else 0.
+
+    if all(ch in names for ch in heogChannels):
+        heog = data[names.index(heogChannels[0])] - data[names.index(heogChannels[1])]
+        features["HEOG"] = sourceCorrelation(sources, heog)
+    else:
+        features["HEOG"] = 0.
+
+    return features
+
+#0-1 sub-scores -> one score per artifact type
+def componentScores(features):
+    frontal = np.clip((features["frontal"] - 1) / 2, 0, 1)
+    spiky = np.clip(features["kurtosis"] / 10, 0, 1)
+    flat = np.clip(features["slope"] + 1, 0, 1)
+    focal = np.clip((features["focal"] - 3) / 3, 0, 1)
+
+    scores = pd.DataFrame(index = features.index)
+    scores["blink"] = (features["VEOG"] + frontal + spiky) / 3
+    scores["saccade"] = (features["HEOG"] + frontal + features["asymmetry"]) / 3
+    scores["muscle"] = (flat + focal) / 2
+
+    return scores
+
+#scores every component, sets ica.exclude, and returns the full decision table
+def classifyComponents(ica, dataICA, thresholds = None):
+    thresholds = dict(defaultThresholds, **(thresholds or {}))
+
+    features = componentFeatures(ica, dataICA)
+    scores = componentScores(features)
+
+    decisions = pd.concat([features, scores.add_prefix("score_")], axis = 1)
+
+    over = pd.DataFrame({label : scores[label] > thresholds[label] for label in scores.columns})
+    decisions["label"] = [", ".join(over.columns[row]) if row.any() else "brain/other"
+                          for row in over.values]
+    decisions["excluded"] = over.any(axis = 1)
+
+    for label, threshold in thresholds.items():
+        decisions["threshold_" + label] = threshold
+
+    ica.exclude = sorted(int(i) for i in decisions.index[decisions.excluded])
+
+    return decisions
+
+###########
+##FITTING##
+###########
+"""
+The ICA is fitted on the decimated 1-40 Hz copy (see filterData), with
+very-high-amplitude stretches annotated as BAD_ica first so they don't drive
+the decomposition. Blinks are well under the threshold, so ICA still sees them.
+"""
+
+#BAD_ica annotations for windows where any channel's peak-to-peak is over peak
+def annotateForICA(dataICA, peak = 500e-6, windowSeconds = 1.):
+    sfreq = dataICA.info["sfreq"]
+    win = int(windowSeconds * sfreq)
+    nWin = dataICA.n_times // win
+
+    data = dataICA.get_data(picks = "eeg", stop = nWin * win)
+    data = data.reshape(data.shape[0], nWin, win)
+    bad = (data.max(axis = 2) - data.min(axis = 2)).max(axis = 0) > peak
+
+    #runs of bad windows -> one annotation each
+    edges = np.diff(np.concatenate([[0], bad.astype(int), [0]]))
+    starts = np.where(edges == 1)[0]
+    stops = np.where(edges == -1)[0]
+
+    onsets = dataICA.first_time + starts * windowSeconds
+    annotations = mne.Annotations(onsets, (stops - starts) * windowSeconds, "BAD_ica",
+                                  orig_time = dataICA.annotations.orig_time)
+    dataICA.set_annotations(dataICA.annotations + annotations)
+
+    return float(bad.mean()) if nWin else 0.
+
+#fit on the decimated copy, timed
+def fitDecimatedICA(dataICA, n_components = 15, max_iter = "auto", random_state = None,
+                    peak = 500e-6):
+    rejected = annotateForICA(dataICA, peak) if peak else 0.
+
+    ica = mne.preprocessing.ICA(n_components = n_components, max_iter = max_iter,
+                                random_state = random_state)
+
+    start = perf_counter()
+    ica.fit(dataICA, reject_by_annotation = True)
+
+    report = {"fitSeconds" : perf_counter() - start,
+              "fitSfreq" : dataICA.info["sfreq"],
+              "fitSamples" : ica.n_samples_,
+              "rejectedFraction" : rejected,
+              }
+
+    return ica, report
+
+#how well two fits agree: components matched one to one on |correlation| of
+#their topographies (sign and order of ICA components are arbitrary)
+def compareICA(ica, icaReference):
+    a = ica.get_components()
+    b = icaReference.get_components()
+    n = a.shape[1]
+
+    corr = np.abs(np.corrcoef(a.T, b.T)[:n, n:])
+    rows, cols = linear_sum_assignment(-corr)
+
+    return {"matchedCorrMean" : float(corr[rows, cols].mean()),
+            "matchedCorrMin" : float(corr[rows, cols].min()),
+            }
+
+#same ICA at the full sampling rate, to check what decimating cost/saved.
+#the BAD_ica stretches of the decimated copy (dataICA) are left out here too,
+#so the only difference is the decimation
+def validateAgainstFullRate(ica, report, rawData, dataICA, lFreqICA, n_components = 15,
+                            max_iter = "auto", random_state = None):
+    fullICA = rawData.copy().load_data().filter(lFreqICA, None, verbose = False)
+
+    rejected = dataICA.annotations[dataICA.annotations.description == "BAD_ica"]
+    fullICA.set_annotations(fullICA.annotations + rejected)
+
+    icaFull = mne.preprocessing.ICA(n_components = n_components, max_iter = max_iter,
+                                    random_state = random_state)
+    start = perf_counter()
+    icaFull.fit(fullICA, reject_by_annotation = True)
+    fullSeconds = perf_counter() - start
+
+    comparison = {"fullRateSeconds" : fullSeconds,
+                  "savedSeconds" : fullSeconds - report["fitSeconds"],
+                  "speedup" : fullSeconds / report["fitSeconds"],
+                  }
+    comparison.update(compareICA(ica, icaFull))
+
+    return comparison
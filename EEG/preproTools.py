@@ -0,0 +1,672 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Mar 23 11:02:14 2024
+
+@author: ambric
+
+Pre-processing steps for a single subject, pulled out of EEGprepro.py so the
+same pipeline can be run interactively (one subject, plots for QC) or
+headless in a batch (EEGprepro_batch.py, one subject per worker process).
+
+Every plot is optional. With review = False nothing blocks, so the whole
+pipeline can run in a worker with no display.
+"""
+import json
+import mne
+import numpy as np
+
+from os import listdir, makedirs, path, remove
+from scipy.signal import oaconvolve
+from time import perf_counter
+
+from badChannels import detectBadChannels
+from brainvisionStream import (BrainVisionRecording, designFilter, icaMatrix, readHeader,
+                               recordingChunks, resampleFactors, spatialMatrix, streamRecordings)
+from icaTools import classifyComponents, fitDecimatedICA, validateAgainstFullRate
+from stageCache import StageCache, fileHash, stageKeys
+
+#default settings for one subject. scripts copy this and change what they need
+defaultParams = {
+    #paths
+    "pathEEG" : "../EEG_data_raw/",
+    "outPath" : "../EEG_data_clean/",
+
+    #lets the pipeline know whether we have EOG electodes
+    "EOG" : False,
+    "EOG_channels" : ("LEYE_beside", "LEYE_below"),
+
+    #extra recordings if a session was split, e.g. {"S40" : ["S40b"]}
+    "additionalRecordings" : {},
+
+    #bad channels known ahead of time, e.g. {"S27" : ["T7"]}
+    "badChannels" : {},
+
+    #find the rest automatically (criteria override badChannels.defaultCriteria)
+    "autoBads" : True,
+    "badCriteria" : {},
+
+    #channel locations
+    "montage" : "easycap-M1",
+
+    #filter bands (see note on filtering in filterData)
+    "filterData" : (.1, 40),
+    "filterICA" : (1, 40),
+
+    #keep every nth sample for the ICA copy (None = as much as the low-pass allows)
+    "icaDecim" : None,
+
+    #ICA
+    "n_components" : 15,
+    "max_iter" : "auto",
+    "random_state" : 97,
+
+    #peak-to-peak (V) over which 1 s of the ICA copy is left out of the fit
+    "icaReject" : 500e-6,
+
+    #also fit at the full rate and report time saved + how well the fits match
+    "icaCompare" : False,
+
+    #score components for blink/saccade/muscle and exclude them automatically
+    #(thresholds override icaTools.defaultThresholds, e.g. {"muscle" : .8})
+    "icaAuto" : True,
+    "icaThresholds" : {},
+
+    #True = blocking plots for marking channels / picking components / QC
+    "review" : False,
+
+    #checkpoint stage outputs on disk and resume from the last one that's
+    #still valid (in-memory path only, and not when reviewing by hand)
+    "cache" : False,
+    "cachePath" : "../EEG_data_cache/",
+    "cacheMaxGB" : 50,
+    "cacheStages" : ("load", "bads", "reference", "filter", "ica"),
+
+    #out-of-core path: memory-map the raw files and work chunk by chunk
+    "streaming" : False,
+    "streamPath" : "../EEG_data_stream/",
+    "chunkSeconds" : 60,
+    #"fir" = zero-phase (same as offline), "iir" = causal butterworth
+    "filterMethod" : "fir",
+
+    #resample (polyphase) after ICA to this rate, e.g. 250 (None = keep as recorded).
+    #must be at least twice the low-pass in filterData
+    "resample" : None,
+
+    #cleaned data as "fif" (double), "h5" (float32, chunked + compressed,
+    #see eegStore.py) or "both"
+    "outFormat" : "fif",
+    "storeChunkSeconds" : 10,
+    }
+
+#every subject with a header file in the raw folder (minus extra recordings)
+def discoverSubjects(pathEEG, additionalRecordings = {}):
+    extras = [s for extra in additionalRecordings.values() for s in extra]
+
+    subjects = [i.split(".")[0] for i in listdir(pathEEG) if i.split(".")[-1] == "vhdr"]
+    subjects = [i for i in subjects if i not in extras]
+    subjects.sort()
+
+    return subjects
+
+###########################
+##STEP 1: IMPORT THE DATA##
+###########################
+
+def loadRecording(subject, params):
+    pathEEG = params["pathEEG"]
+    EOG_channels = params["EOG_channels"]
+
+    ##import the EEG file
+    fileEEG = pathEEG + subject + ".vhdr"
+    rawData = trimForResampling(mne.io.read_raw_brainvision(fileEEG, preload = True, eog = EOG_channels), params)
+
+    #handle sessions with multiple recordings
+    for s in params["additionalRecordings"].get(subject, []):
+        pathAdditional = pathEEG + s + ".vhdr"
+        rawDataAdditional = mne.io.read_raw_brainvision(pathAdditional, preload = True, eog = EOG_channels)
+        rawData.append(trimForResampling(rawDataAdditional, params))
+
+    #someone typed the name of this channel wrong in the lab computer
+    if "FPz" in rawData.ch_names:
+        mne.channels.rename_channels(rawData.info, {"FPz" : "Fpz"})
+
+    #set montage (where channels are located)
+    rawData.set_montage(params["montage"])
+
+    #drop EOG channels if not used for this recording
+    if not params["EOG"]:
+        rawData.drop_channels([ch for ch in EOG_channels if ch in rawData.ch_names])
+
+    return rawData
+
+#MNE resamples each appended recording on its own, and builds the polyphase
+#filter from (new length / old length). cutting every recording to a whole
+#number of "down" samples (a few ms at most) keeps that at e.g. 1/2
+def trimForResampling(rawData, params):
+    if params["resample"] is None:
+        return rawData
+
+    up, down = resampleFactors(rawData.info["sfreq"], params["resample"])
+    nKeep = rawData.n_times // down * down
+
+    return rawData.crop(tmax = rawData.times[nKeep - 1])
+
+###############################
+##STEP 2: REPAIR BAD CHANNELS##
+###############################
+
+#flat/deviating/uncorrelated/noisy EEG channels, saved with the reasons why
+def findBadChannels(chunks, info, subject, params):
+    bads, report = detectBadChannels(chunks, info, params["badCriteria"])
+    report.to_csv(params["outPath"] + subject + "_bad_channels.csv")
+
+    return bads
+
+#EEG channels of a loaded recording, a minute at a time
+def rawChunks(rawData, picks, chunkSeconds = 60):
+    chunk = int(chunkSeconds * rawData.info["sfreq"])
+    for start in range(0, rawData.n_times, chunk):
+        yield rawData.get_data(picks = picks, start = start, stop = start + chunk)
+
+def repairBadChannels(rawData, subject, params):
+    #channels we already know are bad
+    knownBads = params["badChannels"].get(subject, [])
+    rawData.info["bads"] = sorted(set(rawData.info["bads"]) | set(knownBads))
+
+    #automatic detection (marked before the plot, so they can be checked)
+    if params["autoBads"]:
+        picks = mne.pick_types(rawData.info, eeg = True, exclude = [])
+        info = mne.pick_info(rawData.info, picks)
+        autoBads = findBadChannels(rawChunks(rawData, picks), info, subject, params)
+        rawData.info["bads"] = sorted(set(rawData.info["bads"]) | set(autoBads))
+
+    #mark the rest by hand
+    if params["review"]:
+        rawData.plot(block = True)
+
+    badsFound = list(rawData.info["bads"])
+
+    rawData.interpolate_bads()
+
+    return badsFound
+
+########################################
+##STEP 3: RE-REFERENCE TO CHANNEL MEAN##
+########################################
+
+def rereference(rawData):
+    rawData.set_eeg_reference(ref_channels = 'average')
+
+#####################
+##STEP 4: FILTERING##
+#####################
+"""
+A note on filtering: The ICA documentation says it needs at least 1 Hz HP to
+work properly, but there's evidence that that's too aggressive for ERPs.
+
+The solution:
+
+    1. Filter at (1,40) for the ICA and (.1, 40) for the main data.
+    2. Apply the ICA to the main data.
+
+(A reviewer pointed this out on my previous paper.)
+
+Both bands have the same 40 Hz low-pass, so that part is only done once. The
+ICA copy is then taken from the low-passed data, decimated (ICA doesn't need
+the full sampling rate) and kept in float32, which means there's never a
+second full-size copy of the recording in memory.
+"""
+
+#largest decimation that keeps the new sampling rate at 3x the low-pass
+def icaDecimFactor(sfreq, hFreq):
+    return max(1, int(sfreq // (3 * hFreq)))
+
+#zero-phase FIR filter that stays in float32 (mne.filter only takes float64)
+def filterFloat32(data, sfreq, lFreq, hFreq):
+    kernel = mne.filter.create_filter(None, sfreq, lFreq, hFreq, method = "fir",
+                                      phase = "zero", fir_design = "firwin",
+                                      verbose = False).astype(np.float32)
+
+    #reflect the ends so the filter doesn't ring on the edges
+    pad = min(len(kernel) // 2, data.shape[-1] - 1)
+    padded = np.pad(data, ((0, 0), (pad, pad)), mode = "reflect")
+
+    #odd-length linear-phase kernel, so 'same' = no delay
+    filtered = oaconvolve(padded, kernel[np.newaxis, :], mode = "same", axes = -1)
+
+    return filtered[:, pad:pad + data.shape[-1]].astype(np.float32, copy = False)
+
+#decimated float32 copy of the data, read in chunks so the full-rate data
+#is never copied
+def decimatedCopy(rawData, decim, chunkSeconds = 60):
+    nTimes = rawData.n_times
+    chunk = int(chunkSeconds * rawData.info["sfreq"]) // decim * decim
+
+    data = np.empty((len(rawData.ch_names), (nTimes + decim - 1) // decim), dtype = np.float32)
+    for start in range(0, nTimes, chunk):
+        stop = min(start + chunk, nTimes)
+        data[:, start // decim:(stop + decim - 1) // decim] = rawData.get_data(start = start, stop = stop)[:, ::decim]
+
+    return data
+
+#ICA copy of data that's already been low-passed: decimated, float32, then
+#high-passed at the lower rate (much shorter filter)
+def makeICACopy(rawData, params, lowpassed):
+    lFreqICA, hFreqICA = params["filterICA"]
+
+    sfreq = rawData.info["sfreq"]
+    decim = params["icaDecim"] or icaDecimFactor(sfreq, lowpassed)
+    icaData = decimatedCopy(rawData, decim)
+
+    hFreqExtra = hFreqICA if hFreqICA < lowpassed else None
+    icaData = filterFloat32(icaData, sfreq / decim, lFreqICA, hFreqExtra)
+
+    #ICA-only copy needs ICA-only header info
+    icaInfo = rawData.info.copy()
+    with icaInfo._unlock():
+        icaInfo["sfreq"] = sfreq / decim
+        icaInfo["highpass"] = lFreqICA
+        icaInfo["lowpass"] = min(lowpassed, hFreqICA)
+
+    dataICA = mne.io.RawArray(icaData, icaInfo, first_samp = rawData.first_samp // decim, verbose = False)
+    dataICA.set_annotations(rawData.annotations)
+
+    return dataICA
+
+def filterData(rawData, params):
+    lFreqData, hFreq = params["filterData"]
+
+    #both bands share the low-pass, so do it once on the main data
+    rawData.filter(None, hFreq)
+
+    #ICA copy = low-passed data, decimated and float32
+    dataICA = makeICACopy(rawData, params, hFreq)
+
+    #main data only needs the high-pass now
+    rawData.filter(lFreqData, None)
+
+    #check that everything looks good
+    if params["review"]:
+        rawData.plot(block = True)
+
+    return dataICA
+
+###############
+##STEP 5: ICA##
+###############
+
+#fit + pick components to exclude (doesn't touch rawData).
+#the fitted ICA is saved next to the cleaned .fif with the key of everything
+#that went into it (only with the cache on), and reused if nothing up to the
+#fit has changed
+def fitICA(rawData, dataICA, subject, params):
+    icaFile = params["outPath"] + subject + "-ica.fif"
+    fitFile = params["outPath"] + subject + "_ica_fit.json"
+    fitReport = None
+    if path.isfile(icaFile) and path.isfile(fitFile):
+        with open(fitFile) as f:
+            fitReport = json.load(f)
+
+    #hashing the raw files only pays off with the cache on or a fit to reuse
+    fitKey = None
+    if params["cache"] or (fitReport is not None and fitReport.get("key")):
+        fitKey = icaFitKey(subject, params)
+
+    if fitReport is not None and fitKey is not None and fitReport["key"] == fitKey:
+        ica = mne.preprocessing.read_ica(icaFile, verbose = False)
+        ica.exclude = []
+
+    else:
+        ica, fitReport = fitDecimatedICA(dataICA, params["n_components"], params["max_iter"],
+                                         params["random_state"], params["icaReject"])
+
+        #same fit at the full rate, just to see what the decimation changed
+        if params["icaCompare"]:
+            fitReport.update(validateAgainstFullRate(ica, fitReport, rawData, dataICA, params["filterICA"][0],
+                                                     params["n_components"], params["max_iter"],
+                                                     params["random_state"]))
+
+        fitReport["key"] = fitKey
+        ica.save(icaFile, overwrite = True, verbose = False)
+        with open(fitFile, "w") as f:
+            json.dump(fitReport, f, indent = 4)
+
+    print(subject, "ICA fit:", {k : v for k, v in fitReport.items() if k != "key"})
+
+    #EOG channels = can find blink components automatically
+    if params["EOG"]:
+        eogInds, _ = ica.find_bads_eog(dataICA, ch_name = list(params["EOG_channels"]))
+        ica.exclude = eogInds
+
+    #otherwise score the components, and save why each one was kept/dropped
+    elif params["icaAuto"]:
+        decisions = classifyComponents(ica, dataICA, params["icaThresholds"])
+        decisions.to_csv(params["outPath"] + subject + "_ica_decisions.csv")
+
+    #manual ICA if no EOG channels (automatic picks come pre-selected)
+    if not params["EOG"] and params["review"]:
+        ica.plot_components()
+
+        ica.plot_sources(rawData, block = True)
+
+    #saved again with the components that were dropped (for EEGrealtime.py)
+    ica.save(icaFile, overwrite = True, verbose = False)
+
+    return ica
+
+def runICA(rawData, dataICA, subject, params):
+    ica = fitICA(rawData, dataICA, subject, params)
+
+    ica.apply(rawData)
+
+    #verify that it worked
+    if params["review"]:
+        rawData.plot(block = True)
+
+    return ica
+
+####################
+##STEP 6: RESAMPLE##
+####################
+
+#everything downstream is low-passed at 40 Hz, so there's no need to keep the
+#acquisition rate. annotations are in seconds, so events land on the right
+#samples at the new rate
+def resampleData(rawData, params):
+    sfreq = params["resample"]
+    if sfreq is None or sfreq == rawData.info["sfreq"]:
+        return
+
+    if sfreq < 2 * params["filterData"][1]:
+        raise ValueError("resample = {} Hz is below twice the {} Hz low-pass".format(sfreq, params["filterData"][1]))
+
+    rawData.resample(sfreq, method = "polyphase")
+
+###########################
+##SAVE PRE-PROCESSED DATA##
+###########################
+
+def saveClean(rawData, subject, params):
+    outFiles = []
+
+    if params["outFormat"] in ("fif", "both"):
+        outFiles.append(params["outPath"] + subject + "_eeg.fif")
+        rawData.save(outFiles[-1], overwrite = True)
+
+    if params["outFormat"] in ("h5", "both"):
+        from eegStore import saveStore
+
+        outFiles.append(saveStore(rawData, params["outPath"] + subject + "_eeg.h5",
+                                  chunkSeconds = params["storeChunkSeconds"]))
+
+    return " ".join(outFiles)
+
+#in pipeline order
+stageOrder = ["load", "bads", "reference", "filter", "ica", "resample"]
+
+#settings that change each stage's output (what the checkpoint keys are made of)
+def stageSettings(subject, params):
+    settings = [("load", {"recordings" : [subject] + params["additionalRecordings"].get(subject, []),
+                          "montage" : params["montage"],
+                          "EOG" : params["EOG"],
+                          "EOG_channels" : params["EOG_channels"],
+                          "resample" : params["resample"]}),
+                ("bads", {"known" : params["badChannels"].get(subject, []),
+                          "auto" : params["autoBads"],
+                          "criteria" : params["badCriteria"]}),
+                ("reference", {"ref_channels" : "average"}),
+                ("filter", {"filterData" : params["filterData"],
+                            "filterICA" : params["filterICA"],
+                            "icaDecim" : params["icaDecim"]}),
+                ("ica", {"n_components" : params["n_components"],
+                         "max_iter" : params["max_iter"],
+                         "random_state" : params["random_state"],
+                         "EOG" : params["EOG"],
+                         "icaReject" : params["icaReject"],
+                         "icaAuto" : params["icaAuto"],
+                         "icaThresholds" : params["icaThresholds"]}),
+                ("resample", {"sfreq" : params["resample"]}),
+                ]
+
+    return settings
+
+#key for an ICA fit = raw files + every setting up to and including the fit
+#(but not component selection, which happens after)
+def icaFitKey(subject, params):
+    settings = stageSettings(subject, params)[:stageOrder.index("ica")]
+    settings.append(("icaFit", {"n_components" : params["n_components"],
+                                "max_iter" : params["max_iter"],
+                                "random_state" : params["random_state"],
+                                "icaReject" : params["icaReject"],
+                                "streaming" : params["streaming"],
+                                "filterMethod" : params["filterMethod"]}))
+
+    return stageKeys(inputHash(subject, params), settings)["icaFit"]
+
+#hash of every raw file that goes into a subject
+def inputHash(subject, params):
+    files = []
+    for s in [subject] + params["additionalRecordings"].get(subject, []):
+        vhdr = params["pathEEG"] + s + ".vhdr"
+        header = readHeader(vhdr)
+        files += [vhdr, header["dataFile"], header["markerFile"]]
+
+    makedirs(params["cachePath"], exist_ok = True)
+
+    return fileHash([f for f in files if path.isfile(f)],
+                    indexFile = params["cachePath"] + "hashes_" + subject + ".json")
+
+#steps 1-5 + save with the whole recording loaded
+def preprocessInMemory(subject, params, timing, record):
+    rawData = dataICA = ica = None
+    bads = []
+    done = 0
+
+    #pick up from the last valid checkpoint
+    cache = None
+    if params["cache"] and not params["review"]:
+        record["stage"] = "cache"
+        cache = StageCache(params["cachePath"], params["cacheMaxGB"])
+        keys = stageKeys(inputHash(subject, params), stageSettings(subject, params))
+
+        #an entry another worker evicted in the meantime = start from scratch
+        resumed = cache.latest(keys, stageOrder)
+        if resumed is not None:
+            try:
+                rawData, dataICA, ica, meta = cache.load(keys[resumed])
+                bads = meta["bads"]
+                done = stageOrder.index(resumed) + 1
+                record["resumedFrom"] = resumed
+            except FileNotFoundError as error:
+                rawData = dataICA = ica = None
+                record["cacheError"] = repr(error)
+
+    for stage in stageOrder[done:]:
+        record["stage"] = stage
+        stageStart = perf_counter()
+
+        if stage == "load":
+            rawData = loadRecording(subject, params)
+        elif stage == "bads":
+            bads = repairBadChannels(rawData, subject, params)
+        elif stage == "reference":
+            rereference(rawData)
+        elif stage == "filter":
+            dataICA = filterData(rawData, params)
+        elif stage == "ica":
+            ica = runICA(rawData, dataICA, subject, params)
+            dataICA = None
+        elif stage == "resample":
+            resampleData(rawData, params)
+
+        timing[stage] = perf_counter() - stageStart
+
+        #a checkpoint that can't be written is noted, but the subject goes on
+        if cache is not None and stage in params["cacheStages"]:
+            stageStart = perf_counter()
+            try:
+                cache.save(keys[stage], {"stage" : stage, "bads" : bads}, rawData = rawData,
+                           dataICA = dataICA, ica = ica)
+            except Exception as error:
+                record["cacheError"] = repr(error)
+            timing["cache"] = timing.get("cache", 0) + perf_counter() - stageStart
+
+    record["stage"] = "save"
+    stageStart = perf_counter()
+    outFile = saveClean(rawData, subject, params)
+    timing["save"] = perf_counter() - stageStart
+
+    return bads, ica, outFile
+
+################################
+##OUT-OF-CORE (STREAMING) PATH##
+################################
+"""
+Same steps, but the recording is never loaded in full:
+
+    1. Memory-map the raw .eeg file(s) and stream them through interpolation +
+       average reference (one spatial matrix) and the main filter band, into a
+       float32 BrainVision file.
+    2. Build the decimated ICA copy from that file (see note on filtering) and
+       fit the ICA. The extra .1 Hz high-pass is irrelevant for a 1 Hz band.
+    3. Stream the filtered file through the ICA (also just a matrix), resampled
+       on the way out if params["resample"] is set, and save the .fif from disk.
+
+Bad channels can't be marked by hand before step 1, so they come from
+params["badChannels"] and/or the automatic detection.
+"""
+
+def streamSubject(subject, params, timing, record):
+    pathEEG = params["pathEEG"]
+    streamPath = params["streamPath"]
+    EOG_channels = params["EOG_channels"]
+    makedirs(streamPath, exist_ok = True)
+
+    record["stage"] = "stream_filter"
+    stageStart = perf_counter()
+
+    #raw file(s), memory-mapped. someone typed FPz wrong in the lab computer
+    files = [subject] + params["additionalRecordings"].get(subject, [])
+    recordings = [BrainVisionRecording(pathEEG + s + ".vhdr", rename = {"FPz" : "Fpz"}) for s in files]
+    chNames = recordings[0].chNames
+    sfreq = recordings[0].sfreq
+
+    #drop EOG channels if not used for this recording
+    keep = [ch for ch in chNames if params["EOG"] or ch not in EOG_channels]
+    picks = np.array([chNames.index(ch) for ch in keep])
+
+    #interpolation + reference as one matrix
+    info = mne.create_info(keep, sfreq, ["eog" if ch in EOG_channels else "eeg" for ch in keep])
+    info.set_montage(params["montage"])
+    info["bads"] = [ch for ch in params["badChannels"].get(subject, []) if ch in keep]
+
+    #automatic detection straight from the memory-mapped files
+    if params["autoBads"]:
+        eeg = mne.pick_types(info, eeg = True, exclude = [])
+        chunks = recordingChunks(recordings, picks[eeg], params["chunkSeconds"])
+        autoBads = findBadChannels(chunks, mne.pick_info(info, eeg), subject, params)
+        info["bads"] = sorted(set(info["bads"]) | set(autoBads))
+
+    bads = list(info["bads"])
+    spatial = spatialMatrix(info)
+
+    #main band
+    lFreqData, hFreq = params["filterData"]
+    kernel = designFilter(sfreq, lFreqData, hFreq, params["filterMethod"])
+    fir = None if params["filterMethod"] == "iir" else kernel
+    sos = kernel if params["filterMethod"] == "iir" else None
+
+    filteredFile = streamRecordings(recordings, streamPath + subject + "_filtered.vhdr",
+                                    picks = picks, spatial = spatial, fir = fir, sos = sos,
+                                    chunkSeconds = params["chunkSeconds"])
+    timing["stream_filter"] = perf_counter() - stageStart
+
+    #ICA on the decimated copy
+    record["stage"] = "ica"
+    stageStart = perf_counter()
+    rawData = mne.io.read_raw_brainvision(filteredFile, preload = False, eog = EOG_channels)
+    rawData.set_montage(params["montage"])
+
+    dataICA = makeICACopy(rawData, params, hFreq)
+    ica = fitICA(rawData, dataICA, subject, params)
+    del dataICA
+    timing["ica"] = perf_counter() - stageStart
+
+    #ICA applied chunk by chunk (+ resampling)
+    record["stage"] = "stream_save"
+    stageStart = perf_counter()
+    matrix, constant = icaMatrix(ica, rawData.info)
+
+    resample = None
+    if params["resample"] is not None and params["resample"] != sfreq:
+        if params["resample"] < 2 * hFreq:
+            raise ValueError("resample = {} Hz is below twice the {} Hz low-pass".format(params["resample"], hFreq))
+        resample = resampleFactors(sfreq, params["resample"])
+
+    cleanFile = streamRecordings([BrainVisionRecording(filteredFile)], streamPath + subject + "_clean.vhdr",
+                                 spatial = matrix, constant = constant,
+                                 chunkSeconds = params["chunkSeconds"], resample = resample)
+
+    #.fif saved from disk (MNE reads it in buffers)
+    rawData = mne.io.read_raw_brainvision(cleanFile, preload = False, eog = EOG_channels)
+    rawData.set_montage(params["montage"])
+    with rawData.info._unlock():
+        rawData.info["highpass"] = lFreqData
+        rawData.info["lowpass"] = hFreq
+    outFile = saveClean(rawData, subject, params)
+    timing["stream_save"] = perf_counter() - stageStart
+
+    #intermediate files
+    for vhdr in (filteredFile, cleanFile):
+        for ext in (".vhdr", ".vmrk", ".eeg"):
+            remove(path.splitext(vhdr)[0] + ext)
+
+    #verify that it worked
+    if params["review"]:
+        reviewSubject(subject, params)
+
+    return bads, ica, outFile
+
+#full pipeline for one subject. returns a status record instead of raising,
+#so one bad recording doesn't take down the rest of a batch
+def preprocessSubject(subject, params):
+    record = {"subject" : subject, "status" : "ok", "stage" : "", "resumedFrom" : "", "error" : "",
+              "cacheError" : "", "bads" : "", "icaExcluded" : "", "outFile" : ""}
+    timing = {}
+
+    start = perf_counter()
+    try:
+        if params["streaming"]:
+            bads, ica, outFile = streamSubject(subject, params, timing, record)
+
+        else:
+            bads, ica, outFile = preprocessInMemory(subject, params, timing, record)
+
+        record["bads"] = " ".join(bads)
+        record["icaExcluded"] = " ".join(str(i) for i in ica.exclude)
+        record["outFile"] = outFile
+
+        #nobody picked components and nothing did it for us
+        if not (params["EOG"] or params["icaAuto"] or params["review"]):
+            record["status"] = "ok (ICA not reviewed)"
+
+    except Exception as error:
+        record["status"] = "failed at " + record["stage"]
+        record["error"] = repr(error)
+
+    record["seconds"] = perf_counter() - start
+    for key, value in timing.items():
+        record["seconds_" + key] = value
+
+    return record
+
+#open a cleaned file for QC after a batch has finished
+def reviewSubject(subject, params):
+    if params["outFormat"] == "h5":
+        from eegStore import EEGStore
+
+        rawData = EEGStore(params["outPath"] + subject + "_eeg.h5").toRaw()
+    else:
+        rawData = mne.io.read_raw_fif(params["outPath"] + subject + "_eeg.fif", preload = True)
+    rawData.plot(block = True)
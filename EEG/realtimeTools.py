@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr 13 13:05:27 2024
+
+@author: ambric
+
+Pieces for pre-processing/QC while a session is being recorded
+(used by EEGrealtime.py).
+
+Data come in as blocks, either by tailing the .eeg file the recorder is
+writing, or from a local socket standing in for the amplifier. Each block goes
+through the same linear steps as the offline pipeline, but incrementally:
+
+    interpolation + average reference (one spatial matrix)
+    causal IIR filter (state carried from block to block)
+    pre-fitted ICA (also just a matrix + offset)
+
+and into a ring buffer, so QC metrics can be computed over the last few
+seconds without ever holding the whole session.
+"""
+import numpy as np
+import socket
+
+from os import path
+from scipy.signal import sosfilt, sosfilt_zi
+from time import sleep, perf_counter
+
+from brainvisionStream import BrainVisionRecording, readHeader
+
+#last nSamples of a channels x samples signal, in a fixed block of memory
+class RingBuffer:
+    def __init__(self, nChannels, nSamples):
+        self.data = np.zeros((nChannels, nSamples))
+        self.nSamples = nSamples
+        self.nWritten = 0
+
+    #nWritten counts every sample, also ones a long block pushes straight out
+    def write(self, block):
+        n = block.shape[1]
+        kept = block[:, -self.nSamples:]
+        nKept = kept.shape[1]
+
+        start = (self.nWritten + n - nKept) % self.nSamples
+        first = min(nKept, self.nSamples - start)
+        self.data[:, start:start + first] = kept[:, :first]
+        self.data[:, :nKept - first] = kept[:, first:]
+
+        self.nWritten += n
+
+    #most recent n samples, oldest first
+    def latest(self, n):
+        n = min(n, self.nWritten, self.nSamples)
+        end = self.nWritten % self.nSamples
+
+        return np.take(self.data, np.arange(end - n, end), axis = 1, mode = "wrap")
+
+#new samples from a .eeg file that's still being written
+class FileTail:
+    def __init__(self, vhdrPath, rename = {}):
+        self.header = readHeader(vhdrPath)
+        if self.header["orientation"] != "MULTIPLEXED":
+            raise ValueError("only MULTIPLEXED files can be read while recording")
+
+        self.chNames = [rename.get(ch, ch) for ch in self.header["chNames"]]
+        self.sfreq = self.header["sfreq"]
+
+        self.dtype = np.dtype(self.header["dtype"])
+        self.frameBytes = self.dtype.itemsize * self.header["nChannels"]
+        self.offset = 0
+
+    #channels x samples in volts, or None if nothing new yet
+    def read(self):
+        if not path.isfile(self.header["dataFile"]):
+            return None
+
+        with open(self.header["dataFile"], "rb") as f:
+            f.seek(self.offset)
+            raw = f.read()
+
+        #whole frames only; the rest comes next time
+        nFrames = len(raw) // self.frameBytes
+        if nFrames == 0:
+            return None
+        self.offset += nFrames * self.frameBytes
+
+        block = np.frombuffer(raw[:nFrames * self.frameBytes], dtype = self.dtype)
+        block = block.reshape(nFrames, self.header["nChannels"]).T
+
+        return block * self.header["scales"][:, np.newaxis]
+
+#new samples from a local socket: float32 µV, multiplexed, same channels as
+#the .vhdr the amplifier would write
+class SocketSource:
+    def __init__(self, vhdrPath, port, host = "127.0.0.1", rename = {}):
+        header = readHeader(vhdrPath)
+        self.chNames = [rename.get(ch, ch) for ch in header["chNames"]]
+        self.sfreq = header["sfreq"]
+        self.frameBytes = 4 * len(self.chNames)
+        self.pending = b""
+
+        self.sock = socket.create_connection((host, port))
+        self.sock.settimeout(.05)
+        self.closed = False
+
+    def read(self):
+        try:
+            received = self.sock.recv(1 << 20)
+            if received == b"":
+                self.closed = True
+            self.pending += received
+        except socket.timeout:
+            pass
+
+        nFrames = len(self.pending) // self.frameBytes
+        if nFrames == 0:
+            return None
+
+        raw = self.pending[:nFrames * self.frameBytes]
+        self.pending = self.pending[nFrames * self.frameBytes:]
+
+        block = np.frombuffer(raw, dtype = "<f4").reshape(nFrames, len(self.chNames)).T
+
+        return block.astype(np.float64) * 1e-6
+
+#plays an existing recording into a socket at (speed x) real time, so the
+#online pipeline can be tried out without an amplifier
+def serveRecording(vhdrPath, port, speed = 1., blockSeconds = .1, host = "127.0.0.1"):
+    recording = BrainVisionRecording(vhdrPath)
+    block = max(int(blockSeconds * recording.sfreq), 1)
+
+    with socket.create_server((host, port)) as server:
+        connection, _ = server.accept()
+        with connection:
+            start = perf_counter()
+            for i in range(0, recording.nTimes, block):
+                data = recording.read(i, min(i + block, recording.nTimes))
+                connection.sendall(np.ascontiguousarray((data * 1e6).T, dtype = "<f4").tobytes())
+
+                #wait until this block "should" have been recorded
+                due = (i + block) / recording.sfreq / speed
+                sleep(max(due - (perf_counter() - start), 0))
+
+#spatial matrix -> causal filter -> ICA, one block at a time
+class OnlineProcessor:
+    def __init__(self, picks, spatial, sos = None, icaMatrix = None, icaOffset = None):
+        self.picks = picks
+        self.spatial = spatial
+        self.sos = sos
+        self.icaMatrix = icaMatrix
+        self.icaOffset = icaOffset
+        self.zi = None
+
+    #swap in an ICA once one's been fitted
+    def setICA(self, icaMatrix, icaOffset):
+        self.icaMatrix = icaMatrix
+        self.icaOffset = icaOffset
+
+    #returns (referenced, cleaned): referenced is only interpolated/referenced
+    #(for bad channel QC), cleaned is filtered + ICA
+    def process(self, block):
+        referenced = self.spatial @ block[self.picks]
+        cleaned = referenced
+
+        if self.sos is not None:
+            if self.zi is None:
+                self.zi = sosfilt_zi(self.sos)[:, np.newaxis, :] * referenced[np.newaxis, :, :1]
+            cleaned, self.zi = sosfilt(self.sos, cleaned, axis = -1, zi = self.zi)
+
+        if self.icaMatrix is not None:
+            cleaned = self.icaMatrix @ cleaned + self.icaOffset
+
+        return referenced, cleaned
+
+#summary of the last few seconds of cleaned data
+def artifactMetrics(cleaned, sfreq, chNames, ptpThreshold = 150e-6):
+    win = int(sfreq)
+    nWin = cleaned.shape[1] // win
+    if nWin == 0:
+        return {}
+
+    windows = cleaned[:, :nWin * win].reshape(cleaned.shape[0], nWin, win)
+    ptp = windows.max(axis = 2) - windows.min(axis = 2)
+
+    return {"median RMS (uV)" : float(np.median(np.sqrt((cleaned ** 2).mean(axis = 1))) * 1e6),
+            "artifact windows (%)" : float((ptp > ptpThreshold).any(axis = 0).mean() * 100),
+            "worst channel" : chNames[int(np.argmax(ptp.mean(axis = 1)))],
+            }
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr  6 09:48:12 2024
+
+@author: ambric
+
+On-disk checkpoints for the EEGprepro stages, so a re-run only redoes the
+stages whose settings changed.
+
+Every stage output is stored under a key = hash of (key of the stage before
+it, stage name, stage settings), and the first key is the hash of the raw
+files themselves. Changing e.g. the ICA settings changes the ICA key but not
+the filter key, so the next run picks up from the filtered data.
+
+The cache has a size cap. When it's over, the least recently used entries go
+first.
+"""
+import hashlib
+import json
+import mne
+
+from os import getpid, listdir, makedirs, path, rename, stat, utime
+from shutil import rmtree
+from time import time
+
+#sha256 of file contents, read in blocks. remembered per (path, size, mtime)
+#so unchanged multi-GB recordings aren't re-read on every run
+def fileHash(filePaths, indexFile = None):
+    index = {}
+    if indexFile is not None and path.isfile(indexFile):
+        with open(indexFile) as f:
+            index = json.load(f)
+
+    digest = hashlib.sha256()
+    for filePath in filePaths:
+        info = stat(filePath)
+        stamp = "{}|{}|{}".format(path.abspath(filePath), info.st_size, info.st_mtime_ns)
+
+        if stamp not in index:
+            fileDigest = hashlib.sha256()
+            with open(filePath, "rb") as f:
+                for block in iter(lambda: f.read(1 << 24), b""):
+                    fileDigest.update(block)
+            index[stamp] = fileDigest.hexdigest()
+
+        digest.update(index[stamp].encode())
+
+    if indexFile is not None:
+        with open(indexFile, "w") as f:
+            json.dump(index, f)
+
+    return digest.hexdigest()
+
+#one key per stage, each chained on the one before.
+#stages = [(stage name, settings dict), . . .] in pipeline order
+def stageKeys(inputHash, stages):
+    keys = {}
+    parent = inputHash
+    for stage, settings in stages:
+        text = json.dumps([parent, stage, settings], sort_keys = True, default = str)
+        parent = hashlib.sha256(text.encode()).hexdigest()
+        keys[stage] = parent
+
+    return keys
+
+#stage outputs on disk: <cachePath>/<key>/ with raw.fif, ica-data_raw.fif,
+#stage-ica.fif and meta.json (whichever the stage produced)
+class StageCache:
+    def __init__(self, cachePath, maxGB = 50):
+        self.cachePath = cachePath
+        self.maxBytes = maxGB * 1e9
+        makedirs(cachePath, exist_ok = True)
+
+    def entryPath(self, key):
+        return path.join(self.cachePath, key)
+
+    def has(self, key):
+        return path.isfile(path.join(self.entryPath(key), "meta.json"))
+
+    #last stage in stageOrder that's already cached (or None)
+    def latest(self, keys, stageOrder):
+        for stage in reversed(stageOrder):
+            if self.has(keys[stage]):
+                return stage
+
+        return None
+
+    #returns (rawData, dataICA, ica, meta). outputs the stage didn't have come
+    #back as None, outputs it saved that are gone raise FileNotFoundError
+    def load(self, key):
+        entry = self.entryPath(key)
+        metaFile = path.join(entry, "meta.json")
+
+        #used = most recent for LRU
+        utime(metaFile)
+
+        with open(metaFile) as f:
+            meta = json.load(f)
+
+        #saved but gone = another worker evicted the entry while we read it
+        for name in meta.get("files", []):
+            if not path.isfile(path.join(entry, name)):
+                raise FileNotFoundError("cache entry {} lost {}".format(key, name))
+
+        rawData = dataICA = ica = None
+        if path.isfile(path.join(entry, "raw.fif")):
+            rawData = mne.io.read_raw_fif(path.join(entry, "raw.fif"), preload = True, verbose = False)
+        if path.isfile(path.join(entry, "ica-data_raw.fif")):
+            dataICA = mne.io.read_raw_fif(path.join(entry, "ica-data_raw.fif"), preload = True, verbose = False)
+        if path.isfile(path.join(entry, "stage-ica.fif")):
+            ica = mne.preprocessing.read_ica(path.join(entry, "stage-ica.fif"), verbose = False)
+
+        return rawData, dataICA, ica, meta
+
+    #written to a temp folder first (one per process), so a crash never leaves
+    #half an entry and workers saving the same key don't write into each other
+    def save(self, key, meta, rawData = None, dataICA = None, ica = None):
+        entry = self.entryPath(key)
+        if self.has(key):
+            return
+
+        tmp = "{}.{}.tmp".format(entry, getpid())
+        rmtree(tmp, ignore_errors = True)
+        makedirs(tmp)
+
+        #double so a resumed run gives exactly the same result as a fresh one
+        if rawData is not None:
+            rawData.save(path.join(tmp, "raw.fif"), fmt = "double", verbose = False)
+        if dataICA is not None:
+            dataICA.save(path.join(tmp, "ica-data_raw.fif"), fmt = "single", verbose = False)
+        if ica is not None:
+            ica.save(path.join(tmp, "stage-ica.fif"), verbose = False)
+
+        #what's in the entry, so load can tell a missing output from an evicted one
+        files = [name for name, output in (("raw.fif", rawData), ("ica-data_raw.fif", dataICA),
+                                           ("stage-ica.fif", ica)) if output is not None]
+        with open(path.join(tmp, "meta.json"), "w") as f:
+            json.dump(dict(meta, created = time(), files = files), f)
+
+        #another worker may have finished the same entry in the meantime
+        try:
+            if not self.has(key):
+                rmtree(entry, ignore_errors = True)
+                rename(tmp, entry)
+        except OSError:
+            pass
+        rmtree(tmp, ignore_errors = True)
+
+        self.evict()
+
+    #drop least recently used entries until the cache fits. other workers can
+    #be saving/evicting in the same folder, so entries may vanish at any point
+    #(temp folders are theirs, not ours to count or delete)
+    def evict(self):
+        entries = []
+        for key in listdir(self.cachePath):
+            if key.endswith(".tmp"):
+                continue
+
+            metaFile = path.join(self.entryPath(key), "meta.json")
+            folder = self.entryPath(key)
+            try:
+                if not path.isfile(metaFile):
+                    continue
+                size = sum(stat(path.join(folder, name)).st_size for name in listdir(folder))
+                entries.append((stat(metaFile).st_mtime, size, key))
+            except FileNotFoundError:
+                continue
+
+        entries.sort()
+        total = sum(e[1] for e in entries)
+
+        for lastUsed, size, key in entries:
+            if total <= self.maxBytes:
+                break
+
+            rmtree(self.entryPath(key), ignore_errors = True)
+            total -= size
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun May  5 09:21:47 2024
+
+@author: ambric
+
+Pieces of the per-subject TFR computation (tfrTools.conditionPowers) that
+replace tfr_morlet(..., average = True).
+
+Single-trial power only ever exists for one batch of epochs: each batch is
+convolved, its power added to running per-condition sums, and thrown away.
+Peak memory depends on the batch size, not on how many trials there are.
+
+The wavelets (same as MNE's, zero mean) only depend on (sfreq, freqs,
+n_cycles, epoch length), so their FFTs are made once and kept in memory and
+on disk. Every subject/worker process after the first just convolves, and
+only at the (decimated, windowed) samples that are kept.
+
+Inter-trial coherence can be accumulated from the same coefficients as the
+power (ITCAccumulator), so it doesn't cost a second transform.
+"""
+import hashlib
+import json
+import numpy as np
+
+from os import getpid, makedirs, path, rename
+from scipy.fft import fft, ifft, next_fast_len
+
+from mne.time_frequency import morlet
+
+#FFT'd wavelets already made in this process, by key
+_banks = {}
+
+#fast FFT length >= nNeeded that divides into decim equal parts
+def foldedLength(nNeeded, decim):
+    return next_fast_len(int(-(-nNeeded // decim))) * decim
+
+#Morlet wavelets for one (sfreq, freqs, n_cycles, epoch length) and their
+#FFTs at a length where the convolution doesn't wrap around. get one with
+#waveletBank() so it's only ever built once.
+#
+#Only the output samples are computed: samples 0, decim, 2 * decim, . . . of
+#the epoch (same grid as tfr_morlet's decim), and with window = (first, last)
+#sample only the ones in there. Two things make that cheaper than computing
+#everything and throwing most of it away:
+#
+#    - each kernel is phase-shifted so the inverse FFT starts at MNE's "same"
+#      output, and the spectrum is folded decim times onto itself, so a
+#      length nfft / decim inverse FFT gives exactly every decim-th sample
+#    - with a window, only the data the window's outputs depend on (window
+#      + longest wavelet on each side) is transformed
+class WaveletBank:
+    def __init__(self, sfreq, freqs, n_cycles, nTimes, decim = 1, window = None, kernels = None):
+        self.sfreq = sfreq
+        self.freqs = np.asarray(freqs, dtype = float)
+        self.nTimes = nTimes
+        self.decim = decim
+
+        if np.any(self.freqs > sfreq / 2):
+            raise ValueError("frequencies above Nyquist ({} Hz)".format(sfreq / 2))
+
+        wavelets = morlet(sfreq, self.freqs, n_cycles = n_cycles, zero_mean = True)
+        lengths = np.array([len(w) for w in wavelets])
+        if lengths.max() > nTimes:
+            raise ValueError("wavelets ({} samples) longer than the epochs ({} samples)".format(
+                lengths.max(), nTimes))
+
+        #output samples (epoch indices) on the decim grid, inside the window
+        first, last = (0, nTimes - 1) if window is None else window
+        self.outputSamples = np.arange(-(-max(first, 0) // decim) * decim, min(last, nTimes - 1) + 1, decim)
+
+        #data segment those depend on, starting on the decim grid
+        margin = lengths.max()
+        self.segStart = max(self.outputSamples[0] - margin, 0) // decim * decim
+        self.segStop = min(self.outputSamples[-1] + margin + 1, nTimes)
+        nSeg = self.segStop - self.segStart
+
+        self.nfft = foldedLength(nSeg + margin - 1, decim)
+        self.firstOut = (self.outputSamples[0] - self.segStart) // decim
+
+        if kernels is None:
+            #the "same" part of each full convolution starts (len - 1) // 2 in
+            shifts = np.exp(2j * np.pi * np.arange(self.nfft) / self.nfft * ((lengths[:, np.newaxis] - 1) // 2))
+            kernels = np.array([fft(w, self.nfft) for w in wavelets]) * shifts
+        self.kernels = kernels
+
+    #single-trial wavelet coefficients, data = ... x epoch samples -> ... x
+    #freqs x output samples (complex)
+    def coefficients(self, data):
+        spectrum = fft(data[..., self.segStart:self.segStop], self.nfft, axis = -1)
+
+        nOut = len(self.outputSamples)
+        out = np.empty(data.shape[:-1] + (len(self.freqs), nOut), dtype = complex)
+        for i, kernel in enumerate(self.kernels):
+            product = spectrum * kernel
+            folded = product.reshape(product.shape[:-1] + (self.decim, self.nfft // self.decim)).sum(axis = -2)
+
+            out[..., i, :] = ifft(folded, axis = -1)[..., self.firstOut:self.firstOut + nOut] / self.decim
+
+        return out
+
+    #single-trial power (same shape as coefficients)
+    def power(self, data):
+        coefs = self.coefficients(data)
+
+        return coefs.real ** 2 + coefs.imag ** 2
+
+#the bank for these settings: from memory, else from cachePath (if given),
+#else built (and saved there). written to a temp file first, so workers
+#starting at the same time never read half a file
+def waveletBank(sfreq, freqs, n_cycles, nTimes, decim = 1, window = None, cachePath = None):
+    settings = [float(sfreq), list(np.round(np.asarray(freqs, dtype = float), 9)),
+                list(np.round(np.broadcast_to(np.asarray(n_cycles, dtype = float), np.shape(freqs)), 9)),
+                int(nTimes), int(decim), None if window is None else [int(w) for w in window], "zero_mean"]
+    key = hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:16]
+
+    if key in _banks:
+        return _banks[key]
+
+    kernelFile = None if cachePath is None else path.join(cachePath, "wavelets_" + key + ".npy")
+    kernels = None
+    if kernelFile is not None and path.isfile(kernelFile):
+        kernels = np.load(kernelFile, mmap_mode = "r")
+
+    bank = WaveletBank(sfreq, freqs, n_cycles, nTimes, decim, window, kernels)
+
+    if kernelFile is not None and kernels is None:
+        makedirs(cachePath, exist_ok = True)
+        tmp = "{}.{}.tmp.npy".format(kernelFile[:-4], getpid())
+        np.save(tmp, bank.kernels)
+        rename(tmp, kernelFile)
+
+    _banks[key] = bank
+
+    return bank
+
+#running per-condition sums of single-trial power. with variance = True it
+#keeps Welford mean + sum of squared deviations instead (batches merged with
+#Chan et al.'s update), so the variance comes out stable too
+class PowerAccumulator:
+    def __init__(self, nConditions, shape, variance = False):
+        self.variance = variance
+        self.counts = np.zeros(nConditions, dtype = int)
+        self.sums = np.zeros((nConditions,) + tuple(shape))
+        if variance:
+            self.m2 = np.zeros((nConditions,) + tuple(shape))
+
+    #power = epochs x ..., conditionInds = condition of each epoch
+    def add(self, power, conditionInds):
+        for i in np.unique(conditionInds):
+            batch = power[conditionInds == i]
+            nBatch = len(batch)
+
+            if not self.variance:
+                self.sums[i] += batch.sum(axis = 0)
+                self.counts[i] += nBatch
+                continue
+
+            #sums holds the running mean here
+            nOld = self.counts[i]
+            n = nOld + nBatch
+            batchMean = batch.mean(axis = 0)
+            delta = batchMean - self.sums[i]
+
+            self.sums[i] += delta * nBatch / n
+            self.m2[i] += ((batch - batchMean) ** 2).sum(axis = 0) + delta ** 2 * nOld * nBatch / n
+            self.counts[i] = n
+
+    def mean(self, i):
+        return self.sums[i].copy() if self.variance else self.sums[i] / self.counts[i]
+
+    #sample variance across trials (None without variance = True)
+    def var(self, i):
+        if not self.variance:
+            return None
+
+        return self.m2[i] / max(self.counts[i] - 1, 1)
+
+#running per-condition sums of unit phase vectors (coefficients / |coefficients|),
+#so inter-trial coherence (|mean phase vector|, as tfr_morlet's itc) comes out
+#of the same convolution as the power, one batch at a time
+class ITCAccumulator:
+    def __init__(self, nConditions, shape):
+        self.counts = np.zeros(nConditions, dtype = int)
+        self.sums = np.zeros((nConditions,) + tuple(shape), dtype = complex)
+
+    #coefs = epochs x ... (complex), conditionInds = condition of each epoch
+    def add(self, coefs, conditionInds):
+        magnitude = np.abs(coefs)
+        phases = np.divide(coefs, magnitude, out = np.zeros_like(coefs), where = magnitude > 0)
+
+        for i in np.unique(conditionInds):
+            self.sums[i] += phases[conditionInds == i].sum(axis = 0)
+            self.counts[i] += np.sum(conditionInds == i)
+
+    def itc(self, i):
+        return np.abs(self.sums[i]) / self.counts[i]
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Apr 27 10:12:31 2024
+
+@author: ambric
+
+Per-subject steps of groupLevel_allSensors.py (load -> event markers ->
+epochs -> TFRs -> baseline), pulled out so every subject can run in its own
+worker process. The group statistics stay in the script.
+"""
+import json
+import mne
+import numpy as np
+import pandas as pd
+
+from collections import deque
+from os import listdir, makedirs, path, rename
+from shutil import rmtree
+from threading import Condition, Thread
+from time import perf_counter
+
+from stageCache import fileHash, stageKeys
+from tfrEngine import ITCAccumulator, PowerAccumulator, waveletBank
+
+#default settings. the script copies this and changes what it needs
+defaultParams = {
+    "pathEEG" : "../EEG_data_clean/",
+    "pathBehavioral" : "../behavioral_data_clean/",
+
+    #format of the cleaned data: "fif" or "h5" (EEGprepro outFormat). with "h5"
+    #only the epoch windows are read from disk
+    "inFormat" : "fif",
+
+    #epochs (s) and peak-to-peak rejection
+    "tmin" : -1,
+    "tmax" : 7.8,
+    "reject" : dict(eeg = 200e-6), #200 µV
+
+    #power
+    "freqs" : np.logspace(*np.log10([4, 35]), num = 10),
+    "cyclesPerHz" : .5, #n_cycles = freqs * cyclesPerHz
+    "decim" : 3,
+
+    #only compute power inside this part of the epoch, e.g. (0, 7.8) for after
+    #the decision (None = whole epoch). always stretched to cover the baseline
+    "tfrWindow" : None,
+
+    #baseline correction
+    "baseline" : (-1, 0),
+    "baselineMode" : "ratio",
+
+    #epochs per convolution batch (every condition's TFR comes out of one
+    #pass over all epochs, in batches of this many)
+    "tfrBatch" : 32,
+
+    #also keep the across-trial variance of (non-baselined) power per condition
+    "tfrVariance" : False,
+
+    #also inter-trial coherence per condition (from the same convolution as the
+    #power, not baselined), cached and in the group tensors as itc_<condition>
+    "tfrITC" : False,
+
+    #conditions you'll be contrasting (group test on the first two)
+    "contrast" : ['B-A', 'T-A', 'K-A'],
+    "nConditions" : 2,
+
+    #keep each subject's TFRs on disk, so a group run only computes subjects
+    #that are new or changed (or all of them, if a setting below changed)
+    "tfrCache" : True,
+    "tfrCachePath" : "../EEG_data_cache/tfr/",
+
+    #group data (subjects x freqs x times x channels, float32) for every
+    #condition in contrast, memory-mapped here. workers fill their own subject
+    "groupPath" : "../EEG_data_cache/group/",
+
+    #subjects loaded ahead (file + behavioral csv + epochs read into memory)
+    #by a background thread while the one before is transformed (0 = load
+    #each one when it's needed). no new load is started while the waiting
+    #subjects' epochs take more than prefetchMemory bytes (per worker)
+    "prefetchDepth" : 1,
+    "prefetchMemory" : 2e9,
+    }
+
+#settings that change a subject's TFRs (what the cache keys are made of)
+tfrSettings = ("inFormat", "tmin", "tmax", "reject", "freqs", "cyclesPerHz", "decim", "tfrWindow",
+               "baseline", "baselineMode", "tfrVariance", "tfrITC")
+
+#need this to handle event IDs
+def eventMapper(markerString):
+    #start of recording
+    if markerString == 'New Segment/':
+        eventID = 9999
+    else:
+        eventID = int(markerString.replace('Stimulus/S', ''))
+
+    return eventID
+
+#markers for response routine
+respMarkers = (200, 201, 222)
+
+#literal mapping different marker for each block
+markerMapping = {"T-M" : 300, "T-A" : 301,
+                 "B-M" : 310, "B-A" : 311,
+                 "K-M" : 320, "K-A" : 321
+                 }
+
+#############
+##LOAD DATA##
+#############
+
+#every subject with a cleaned file (folder also has ICA files/reports in it)
+def discoverSubjects(pathEEG, inFormat = "fif"):
+    return sorted(i.split("_")[0] for i in listdir(pathEEG) if i.endswith("_eeg." + inFormat))
+
+#events + something to epoch from (Raw, or EEGStore for .h5)
+def loadSubject(subject, params):
+    fileEEG = params["pathEEG"] + subject + "_eeg." + params["inFormat"]
+
+    if params["inFormat"] == "h5":
+        from eegStore import EEGStore
+
+        source = EEGStore(fileEEG)
+        events = source.events(eventMapper)
+    else:
+        #read per epoch batch, not held in memory
+        source = mne.io.read_raw_fif(fileEEG, preload = False)
+        events, event_dict = mne.events_from_annotations(source, event_id = eventMapper)
+
+    return source, events
+
+#######################################
+##STEP 6: APPLY DESIRED EVENT MARKERS##
+#######################################
+
+#decision frames of correct attributions get the block's marker (in place).
+#structure = [[starting sample, duration, maker], . . .]. the nth response
+#marker goes with the nth row of the behavioral file, and the decision frame is
+#offset events before the response frame. raises if the two don't line up
+def remapEvents(events, behavioralData, offset = 10):
+    #every response marker (event 0 = marker for recording start)
+    respInds = np.flatnonzero(np.isin(events[1:, 2], respMarkers)) + 1
+    decisionInds = respInds - offset
+
+    problems = []
+    if len(respInds) != len(behavioralData):
+        problems.append("{} response markers in the EEG but {} trials in the behavioral file".format(
+            len(respInds), len(behavioralData)))
+
+    #decision frame before the start, or inside the previous trial
+    early = np.flatnonzero(decisionInds < 1)
+    if len(early):
+        problems.append("responses {} are fewer than {} events from the start".format(list(early), offset))
+
+    overlap = np.flatnonzero(np.diff(respInds) < offset) + 1
+    if len(overlap):
+        problems.append("responses {} are fewer than {} events after the previous one".format(list(overlap), offset))
+
+    blocks = behavioralData.block.to_numpy()
+    unknown = set(blocks) - set(markerMapping)
+    if unknown:
+        problems.append("blocks {} have no marker in markerMapping".format(sorted(unknown)))
+
+    if problems:
+        raise ValueError("events and behavioral data don't line up:\n    " + "\n    ".join(problems))
+
+    #correct attribution only (perception)
+    correct = (behavioralData.resp.to_numpy() == "left") & (behavioralData.cor_resp.to_numpy() == 1)
+
+    #block names -> markers via a lookup table
+    names, blockInds = np.unique(blocks[correct], return_inverse = True)
+    codes = np.array([markerMapping[name] for name in names], dtype = events.dtype)
+
+    events[decisionInds[correct], 2] = codes[blockInds]
+
+    return events
+
+#################
+##STEP 7: EPOCH##
+#################
+
+#preload = read the epochs' data now (.h5 epochs always are)
+def epochSubject(source, events, params, preload = False):
+    if params["inFormat"] == "h5":
+        epochs = source.epochs(events, markerMapping, tmin = params["tmin"], tmax = params["tmax"])
+        source.close()
+    else:
+        epochs = mne.Epochs(source, events, event_id = markerMapping,
+                            tmin = params["tmin"], tmax = params["tmax"], preload = preload)
+
+    epochs.drop_bad(reject = params["reject"])
+
+    return epochs
+
+################
+##STEP 8: TFRs##
+################
+
+#wavelet FFTs shared by every subject/worker with the same settings. output
+#samples = every decim-th, inside the window (+ baseline)
+def outputBank(sfreq, epochTimes, params):
+    freqs = params["freqs"]
+
+    window = None
+    if params["tfrWindow"] is not None:
+        tmin = min(params["tfrWindow"][0], params["baseline"][0] if params["baseline"][0] is not None else -np.inf)
+        tmax = max(params["tfrWindow"][1], params["baseline"][1] if params["baseline"][1] is not None else np.inf)
+        window = (int(np.searchsorted(epochTimes, tmin - 1e-9)), int(np.searchsorted(epochTimes, tmax + 1e-9)) - 1)
+
+    return waveletBank(sfreq, freqs, freqs * params["cyclesPerHz"], len(epochTimes), params["decim"], window,
+                       params["tfrCachePath"] if params["tfrCache"] else None)
+
+#baseline-corrected average power for every condition in markerMapping, as
+#{condition : (f bands, samples, channels)}. every epoch is convolved once
+#(batches of all conditions mixed), and its power is added to its
+#condition's running sum, so more conditions cost next to nothing and only
+#one batch is ever in memory. same as tfr_morlet(epochs[condition],
+#average = True) per condition, except the convolution is done with FFTs
+#and only at the samples that are kept (see tfrEngine.WaveletBank).
+#variances and inter-trial coherences (same shape, or None) with
+#params["tfrVariance"] and params["tfrITC"]
+def conditionPowers(epochs, params):
+    freqs = params["freqs"]
+
+    picks = mne.pick_types(epochs.info, eeg = True)
+
+    #epoch -> condition (only conditions with epochs)
+    codes = epochs.events[:, 2]
+    conditions = [c for c in markerMapping if np.any(codes == markerMapping[c])]
+    conditionInds = np.array([[markerMapping[c] for c in conditions].index(code) for code in codes], dtype = int)
+
+    bank = outputBank(epochs.info["sfreq"], epochs.times, params)
+    times = epochs.times[bank.outputSamples]
+
+    shape = (len(picks), len(freqs), len(times))
+    accumulator = PowerAccumulator(len(conditions), shape, params["tfrVariance"])
+    itcAccumulator = ITCAccumulator(len(conditions), shape) if params["tfrITC"] else None
+    for start in range(0, len(epochs), params["tfrBatch"]):
+        data = epochs[start:start + params["tfrBatch"]].get_data(picks = picks)
+        batchInds = conditionInds[start:start + params["tfrBatch"]]
+
+        if itcAccumulator is None:
+            power = bank.power(data)
+        else:
+            coefs = bank.coefficients(data)
+            itcAccumulator.add(coefs, batchInds)
+            power = coefs.real ** 2 + coefs.imag ** 2
+            del coefs
+
+        accumulator.add(power, batchInds)
+        del power
+
+    powers = {}
+    variances = {} if params["tfrVariance"] else None
+    itcs = {} if params["tfrITC"] else None
+    for i, condition in enumerate(conditions):
+        average = accumulator.mean(i)
+        mne.baseline.rescale(average, times, params["baseline"], mode = params["baselineMode"], copy = False)
+
+        powers[condition] = np.transpose(average, (1, 2, 0))
+        if variances is not None:
+            variances[condition] = np.transpose(accumulator.var(i), (1, 2, 0))
+        if itcs is not None:
+            itcs[condition] = np.transpose(itcAccumulator.itc(i), (1, 2, 0))
+
+    return powers, times, variances, itcs
+
+###################
+##TFR CHECKPOINTS##
+###################
+
+#key = hash of the cleaned + behavioral files and the TFR settings. run in the
+#main process only (the file hash index isn't safe to share between workers)
+def tfrKey(subject, params):
+    files = [params["pathEEG"] + subject + "_eeg." + params["inFormat"],
+             params["pathBehavioral"] + subject + ".csv"]
+    files = [f for f in files if path.isfile(f)] #missing = fails later, with a proper record
+    makedirs(params["tfrCachePath"], exist_ok = True)
+    inputHash = fileHash(files, params["tfrCachePath"] + "hashes.json")
+
+    settings = {key : params[key] for key in tfrSettings}
+    settings["freqs"] = list(np.round(settings["freqs"], 6))
+    settings["conditions"] = markerMapping
+
+    return stageKeys(inputHash, [("tfr", settings)])["tfr"]
+
+#result with the powers memory-mapped from the cache (None if not cached)
+def loadCachedTFR(subject, key, params):
+    entry = path.join(params["tfrCachePath"], key)
+    if not path.isfile(path.join(entry, "meta.json")):
+        return None
+
+    with open(path.join(entry, "meta.json")) as f:
+        result = json.load(f)
+
+    result["powers"] = {condition : np.load(path.join(entry, "power_{}.npy".format(condition)), mmap_mode = "r")
+                        for condition in result["conditions"]}
+    result["variances"] = None
+    if params["tfrVariance"]:
+        result["variances"] = {condition : np.load(path.join(entry, "var_{}.npy".format(condition)), mmap_mode = "r")
+                               for condition in result["conditions"]}
+    result["itcs"] = None
+    if params["tfrITC"]:
+        result["itcs"] = {condition : np.load(path.join(entry, "itc_{}.npy".format(condition)), mmap_mode = "r")
+                          for condition in result["conditions"]}
+    result["times"] = np.load(path.join(entry, "times.npy"))
+    result["info"] = mne.io.read_info(path.join(entry, "epochs-info.fif"), verbose = False)
+    result["subject"] = subject
+    result["status"] = "ok (cached)"
+    result["seconds"] = 0
+
+    return result
+
+#written to a temp folder first, so a crash never leaves half an entry
+def saveCachedTFR(key, result, params):
+    entry = path.join(params["tfrCachePath"], key)
+    tmp = entry + ".tmp"
+    rmtree(tmp, ignore_errors = True)
+    makedirs(tmp)
+
+    for condition, power in result["powers"].items():
+        np.save(path.join(tmp, "power_{}.npy".format(condition)), power)
+    for condition, variance in (result["variances"] or {}).items():
+        np.save(path.join(tmp, "var_{}.npy".format(condition)), variance)
+    for condition, itc in (result["itcs"] or {}).items():
+        np.save(path.join(tmp, "itc_{}.npy".format(condition)), itc)
+    np.save(path.join(tmp, "times.npy"), result["times"])
+    mne.io.write_info(path.join(tmp, "epochs-info.fif"), result["info"])
+
+    meta = {k : v for k, v in result.items() if k not in ("powers", "times", "variances", "itcs", "info", "seconds")}
+    with open(path.join(tmp, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    rmtree(entry, ignore_errors = True)
+    rename(tmp, entry)
+
+################
+##GROUP TENSOR##
+################
+
+def groupFile(condition, params):
+    return path.join(params["groupPath"], "group_{}.npy".format(condition))
+
+#name of a condition's ITC in the group tensors
+def itcName(condition):
+    return "itc_" + condition
+
+#what goes into the group tensors: every condition in contrast, and its ITC
+#with params["tfrITC"]
+def groupNames(params):
+    return list(params["contrast"]) + ([itcName(c) for c in params["contrast"]] if params["tfrITC"] else [])
+
+#(freqs, times, channels) every subject's TFRs will have, from the first file
+def groupShape(subject, params):
+    fileEEG = params["pathEEG"] + subject + "_eeg." + params["inFormat"]
+    if params["inFormat"] == "h5":
+        from eegStore import EEGStore
+
+        info = EEGStore(fileEEG).info
+    else:
+        info = mne.io.read_info(fileEEG, verbose = False)
+
+    sfreq = info["sfreq"]
+    epochTimes = np.arange(int(np.round(params["tmin"] * sfreq)), int(np.round(params["tmax"] * sfreq)) + 1) / sfreq
+    bank = outputBank(sfreq, epochTimes, params)
+
+    return (len(params["freqs"]), len(bank.outputSamples), len(mne.pick_types(info, eeg = True)))
+
+#one float32 .npy per condition in contrast (+ one per ITC), (subjects x
+#freqs x times x channels), preallocated on disk
+def createGroupTensors(subjects, params):
+    makedirs(params["groupPath"], exist_ok = True)
+    shape = (len(subjects),) + groupShape(subjects[0], params)
+
+    tensors = {condition : np.lib.format.open_memmap(groupFile(condition, params), mode = "w+",
+                                                     dtype = np.float32, shape = shape)
+               for condition in groupNames(params)}
+
+    with open(path.join(params["groupPath"], "subjects.json"), "w") as f:
+        json.dump(subjects, f)
+
+    return tensors
+
+#one subject's TFRs (and ITCs) straight into its slot (opened per call, so it
+#works the same in a worker process)
+def writeGroupSlot(slot, powers, params, itcs = None):
+    values = dict(powers)
+    values.update({itcName(condition) : itc for condition, itc in (itcs or {}).items()})
+
+    for name in groupNames(params):
+        if name not in values:
+            continue
+
+        tensor = np.lib.format.open_memmap(groupFile(name, params), mode = "r+")
+        if tensor.shape[1:] != values[name].shape:
+            raise ValueError("TFR shape {} doesn't match the group's {}".format(values[name].shape,
+                                                                               tensor.shape[1:]))
+        tensor[slot] = values[name]
+        tensor.flush()
+        del tensor
+
+#keep only the slots in keep (in order), moved down in place.
+#returns views of the first len(keep) subjects
+def compactGroupTensors(tensors, keep):
+    for condition, tensor in tensors.items():
+        for i, slot in enumerate(keep):
+            if slot != i:
+                tensor[i] = tensor[slot]
+        tensor.flush()
+
+    return {condition : tensor[:len(keep)] for condition, tensor in tensors.items()}
+
+#record subjectTFR (and subjectTFRs) return for every subject
+def newResult(subject):
+    return {"subject" : subject, "status" : "ok", "stage" : "", "error" : "",
+            "powers" : None, "times" : None, "variances" : None, "itcs" : None, "info" : None}
+
+def failResult(result, error):
+    result["status"] = "failed at " + result["stage"]
+    result["error"] = repr(error)
+
+#load -> events -> epochs (everything that reads files). result keeps track
+#of the stage and gets the epoch counts
+def prepareSubject(subject, params, result, preload = False):
+    result["stage"] = "load"
+    source, events = loadSubject(subject, params)
+    behavioralData = pd.read_csv(params["pathBehavioral"] + subject + ".csv")
+
+    result["stage"] = "events"
+    events = remapEvents(events, behavioralData)
+
+    result["stage"] = "epochs"
+    epochs = epochSubject(source, events, params, preload)
+    for condition, code in markerMapping.items():
+        result["n_" + condition] = int(np.sum(epochs.events[:, 2] == code))
+
+    return epochs
+
+#TFR -> cache -> group tensors
+def finishSubject(epochs, params, result, key = None, slot = None):
+    result["stage"] = "tfr"
+    result["powers"], result["times"], result["variances"], result["itcs"] = conditionPowers(epochs, params)
+    result["info"] = mne.pick_info(epochs.info, mne.pick_types(epochs.info, eeg = True))
+    result["conditions"] = list(result["powers"])
+
+    if key is not None:
+        result["stage"] = "cache"
+        saveCachedTFR(key, result, params)
+
+    if slot is not None:
+        result["stage"] = "group"
+        writeGroupSlot(slot, result["powers"], params, result["itcs"])
+        result["powers"] = result["variances"] = result["itcs"] = None
+
+#all of the above for one subject. returns a record instead of raising, so one
+#bad subject doesn't take down the whole group run. with a cache key, the
+#result is also checkpointed, and with a slot it goes into the group tensors
+#(and isn't sent back). the epochs' data are read batch by batch during the
+#TFR, so ioWait only covers load -> epochs and the rest is in computeSeconds
+def subjectTFR(subject, params, key = None, slot = None):
+    result = newResult(subject)
+
+    start = perf_counter()
+    loaded = None
+    try:
+        epochs = prepareSubject(subject, params, result)
+        loaded = perf_counter()
+
+        finishSubject(epochs, params, result, key, slot)
+    except Exception as error:
+        failResult(result, error)
+
+    end = perf_counter()
+    result["seconds"] = end - start
+    result["ioWait"] = (loaded or end) - start
+    result["computeSeconds"] = end - (loaded or end)
+
+    return result
+
+############
+##PREFETCH##
+############
+
+#hand-over between the loader thread and the TFR loop: at most depth subjects
+#waiting, and no new load while the waiting ones hold maxBytes or more
+class PrefetchQueue:
+    def __init__(self, depth, maxBytes):
+        self.depth = depth
+        self.maxBytes = maxBytes
+        self.items = deque()
+        self.nBytes = 0
+        self.condition = Condition()
+
+    def hasRoom(self):
+        return not self.items or (len(self.items) < self.depth and self.nBytes < self.maxBytes)
+
+    def waitForRoom(self):
+        with self.condition:
+            self.condition.wait_for(self.hasRoom)
+
+    def put(self, item, nBytes):
+        with self.condition:
+            self.items.append((item, nBytes))
+            self.nBytes += nBytes
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.items)
+            item, nBytes = self.items.popleft()
+            self.nBytes -= nBytes
+            self.condition.notify_all()
+
+        return item
+
+#size of the epochs' data once in memory
+def epochsBytes(epochs):
+    return len(epochs) * epochs.info["nchan"] * len(epochs.times) * 8
+
+#loader thread: (result, epochs or None if it failed) for each subject, in order
+def _loadAhead(subjects, params, queue):
+    for subject in subjects:
+        queue.waitForRoom()
+
+        result = newResult(subject)
+        epochs = None
+        start = perf_counter()
+        try:
+            epochs = prepareSubject(subject, params, result, preload = True)
+        except Exception as error:
+            failResult(result, error)
+        result["loadSeconds"] = perf_counter() - start
+
+        queue.put((result, epochs), epochsBytes(epochs) if epochs is not None else 0)
+
+#subjectTFR for several subjects in a row (e.g. everything one worker gets),
+#with the next subject loaded in the background while the current one's TFR is
+#computed (params["prefetchDepth"], params["prefetchMemory"]). each record
+#also has ioWait (s blocked waiting for data) and computeSeconds. with
+#prefetchDepth = 0 it's just subjectTFR for each one
+def subjectTFRs(subjects, params, keys = None, slots = None):
+    keys = keys if keys is not None else [None] * len(subjects)
+    slots = slots if slots is not None else [None] * len(subjects)
+
+    queue = None
+    if params["prefetchDepth"] > 0:
+        queue = PrefetchQueue(params["prefetchDepth"], params["prefetchMemory"])
+        Thread(target = _loadAhead, args = (subjects, params, queue), daemon = True).start()
+
+    #no prefetch: epochs stay on disk and are read batch by batch
+    if queue is None:
+        return [subjectTFR(subject, params, key, slot) for subject, key, slot in zip(subjects, keys, slots)]
+
+    results = []
+    for subject, key, slot in zip(subjects, keys, slots):
+        start = perf_counter()
+        result, epochs = queue.get()
+        result["ioWait"] = perf_counter() - start
+
+        start = perf_counter()
+        if epochs is not None:
+            try:
+                finishSubject(epochs, params, result, key, slot)
+            except Exception as error:
+                failResult(result, error)
+        del epochs
+        result["computeSeconds"] = perf_counter() - start
+
+        result["seconds"] = result["ioWait"] + result["computeSeconds"]
+        results.append(result)
+
+    return results